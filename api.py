@@ -0,0 +1,249 @@
+import hashlib
+import hmac
+import io
+from datetime import date
+from email.utils import formatdate, parsedate_to_datetime
+import pandas as pd
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from utils.server_utils import as_float64, expand_soil_cols, get_sheet_columns, get_variables, \
+    parse_sheet
+from utils.sheet_store import SharedSheetStore, store, frequencies
+from utils.memory_utils import memory
+from config import ingest_config
+
+# 資料 API：與儀表板共用同一份表格與彙總快取
+
+cache_max_age = 60
+
+# 單次推送的資料列上限
+ingest_max_rows = ingest_config.get("max_rows", 10000)
+
+# 推送的時間最多可以比伺服器的現在時間晚幾分鐘（容許閘道時鐘誤差）
+ingest_future_minutes = ingest_config.get("future_minutes", 10)
+
+arrow_media_type = "application/vnd.apache.arrow.stream"
+
+
+def error(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+def cache_headers(etag: str) -> dict:
+    """
+    條件式 GET 與快取用的回應標頭
+    """
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(store.loaded_at, usegmt=True),
+        "Cache-Control": f"public, max-age={cache_max_age}",
+    }
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """
+    判斷用戶端的快取是否仍然有效
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [i.strip() for i in if_none_match.split(",")] \
+            or if_none_match.strip() == "*"
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(store.loaded_at) <= since
+
+    return False
+
+
+def to_arrow(df) -> bytes | None:
+    """
+    序列化為 Arrow IPC stream；沒有安裝 pyarrow（poetry install -E arrow）時回傳 None
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def index(request: Request):
+    """
+    列出可用的位置、頻率與變數
+    """
+    store.ensure_loaded()
+    locations = dict()
+    for location in store.locations:
+        m, M = store.date_range(location)
+        locations[location] = {
+            "variables": get_variables(store.get(location), derived=True),
+            "start": m.isoformat(),
+            "end": M.isoformat(),
+        }
+
+    return JSONResponse(
+        {
+            "version": store.version,
+            "frequencies": list(frequencies.keys()),
+            "locations": locations,
+        },
+        headers={"Cache-Control": f"public, max-age={cache_max_age}"},
+    )
+
+
+def sheet(request: Request):
+    """
+    取得某位置、頻率的資料
+
+    查詢參數：start、end（YYYY-MM-DD）、variables（以逗號分隔）、format（json 或 arrow）
+    """
+    location = request.path_params["location"]
+    frequency = request.path_params["frequency"]
+    if location not in store.locations:
+        return error(404, f"unknown location: {location}")
+    if frequency not in frequencies:
+        return error(404, f"unknown frequency: {frequency}")
+
+    df = store.rollup(location, frequency)
+    m, M = store.date_range(location)
+    params = request.query_params
+    try:
+        m = date.fromisoformat(params.get("start", m.isoformat()))
+        M = date.fromisoformat(params.get("end", M.isoformat()))
+    except ValueError:
+        return error(400, "start and end must be dates in YYYY-MM-DD format")
+
+    variables = get_variables(df)
+    if "variables" in params:
+        variables = expand_soil_cols(
+            [i for i in params["variables"].split(",") if i])
+        known = get_variables(df, derived=True)
+        unknown = [i for i in variables if i not in known]
+        if unknown:
+            return error(400, f"unknown variables: {', '.join(unknown)}")
+
+    fmt = params.get("format")
+    if fmt is None:
+        fmt = "arrow" if arrow_media_type in request.headers.get(
+            "accept", "") else "json"
+    if fmt not in ["json", "arrow"]:
+        return error(400, f"unknown format: {fmt}")
+
+    key = f"{store.version}|{location}|{frequency}|{m}|{M}|{','.join(variables)}|{fmt}"
+    etag = '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+    headers = cache_headers(etag)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    df = store.select(location, frequency, m, M, variables)
+
+    if fmt == "arrow":
+        body = to_arrow(df)
+        if body is None:
+            return error(406, "arrow format requires pyarrow")
+        return Response(body, media_type=arrow_media_type, headers=headers)
+
+    body = as_float64(df, rounded=True).to_json(orient="split", index=False,
+                      date_format="iso", force_ascii=False)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def memory_usage(request: Request):
+    """
+    各 session 的記憶體用量（位元組）
+    """
+    return JSONResponse(memory.report(),
+                        headers={"Cache-Control": "no-store"})
+
+
+def parse_rows(location: str, rows: list) -> pd.DataFrame:
+    """
+    依表格的欄位格式驗證並轉換推送的資料列
+    """
+    columns = ['時間'] + get_sheet_columns(location)
+    df = pd.DataFrame(rows)
+    unknown = [i for i in df.columns if i not in columns]
+    if unknown:
+        raise ValueError(f"unknown columns: {', '.join(map(str, unknown))}")
+    if '時間' not in df.columns or df['時間'].isna().any():
+        raise ValueError("every row needs 時間 (YYYY-MM-DD HH:MM:SS)")
+
+    # 與讀取 CSV 相同，先轉成字串再交給 parse_sheet 處理缺失值與型別
+    df = df.reindex(columns=columns).fillna("").astype(str)
+    df = parse_sheet(df, location)
+
+    # 未來時間的資料列會讓之後所有推送都被視為較舊而丟棄
+    limit = pd.Timestamp.now() + pd.Timedelta(minutes=ingest_future_minutes)
+    future = int((df['時間'] > limit).sum())
+    if future:
+        raise ValueError(
+            f"{future} rows are more than {ingest_future_minutes} minutes in the future")
+    return df
+
+
+async def ingest(request: Request):
+    """
+    接收感測器閘道推送的資料列
+
+    POST /api/ingest/{location}，Authorization: Bearer <token>，
+    內容為 {"rows": [{"時間": "2023-08-01 12:00:00", "氣溫": 25.1, ...}, ...]}
+    """
+    token = ingest_config.get("token")
+    if not token:
+        return error(403, "ingestion is disabled")
+    # 以固定時間比較，避免由回應時間推測 token
+    authorization = request.headers.get("authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return error(401, "invalid token")
+
+    location = request.path_params["location"]
+    if location not in store.locations:
+        return error(404, f"unknown location: {location}")
+
+    try:
+        body = await request.json()
+    except ValueError:
+        return error(400, "body must be JSON")
+    rows = body.get("rows") if isinstance(body, dict) else body
+    if not isinstance(rows, list) or not rows \
+            or not all(isinstance(i, dict) for i in rows):
+        return error(400, "rows must be a non-empty list of objects")
+    if len(rows) > ingest_max_rows:
+        return error(413, f"at most {ingest_max_rows} rows per request")
+
+    try:
+        df = parse_rows(location, rows)
+    except (ValueError, TypeError) as e:
+        return error(400, str(e))
+
+    appended, older = await run_in_threadpool(store.append, location, df)
+
+    # 共享記憶體模式下由 loader 合併，資料列在下一個發布的版本才會出現
+    if isinstance(store, SharedSheetStore):
+        return JSONResponse({"received": len(df), "queued": appended,
+                             "older": older, "version": store.version},
+                            status_code=202)
+    return JSONResponse({"received": len(df), "appended": appended,
+                         "older": older, "version": store.version})
+
+
+api = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/memory", memory_usage),
+        Route("/ingest/{location}", ingest, methods=["POST"]),
+        Route("/{location}/{frequency}", sheet),
+    ]
+)
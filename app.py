@@ -1,11 +1,14 @@
 from shiny import App, Inputs, Outputs, Session, ui, reactive
+from starlette.applications import Starlette
+from starlette.routing import Mount
 from shiny.types import NavSetArg
 from typing import List
 from utils.ui_utils import (
     container, 
     faicon
 )
-from utils.server_utils import reload_all
+from utils.sheet_store import reload_all, store
+from utils.memory_utils import session_memory
 from config import (
     root_dir,
     js_path,
@@ -24,6 +27,11 @@ from modules.dataframe import (
     dataframe_ui,
     dataframe_server,
 )
+from modules.alerts import (
+    alerts_ui,
+    alerts_server,
+)
+from api import api
 
 
 def introduction_ui():
@@ -57,6 +65,11 @@ def nav_controls() -> List[NavSetArg]:
             dataframe_ui("dataframe"),
             icon=faicon("fa-solid fa-table me-1")
         ),
+        ui.nav(
+            "警示",
+            alerts_ui("alerts"),
+            icon=faicon("fa-solid fa-bell me-1")
+        ),
         ui.nav_spacer(),
         ui.nav_control(
             ui.input_action_button(
@@ -102,21 +115,38 @@ def ui_():
 
 
 def server(input: Inputs, output: Outputs, session: Session):
-    indoor_sheet = reactive.Value()
-    outdoor_sheet = reactive.Value()
+    memory = session_memory(session)
+
+    indoor_sheet = memory.track("indoor_sheet", reactive.Value(), shared=True)
+    outdoor_sheet = memory.track("outdoor_sheet", reactive.Value(), shared=True)
     reload_all(
         indoor_sheet=indoor_sheet,
         outdoor_sheet=outdoor_sheet
     )
 
-    user_sheet = reactive.Value()
+    user_sheet = memory.track("user_sheet", reactive.Value())
+
+    # 其他 session 重新讀取或閘道推送資料後，同步更新這個 session 的表格
+    @reactive.poll(store.poll_version, 5)
+    def sheet_version():
+        return store.version
+
+    @reactive.Effect
+    def _():
+        sheet_version()
+        with reactive.isolate():
+            if indoor_sheet.get() is not store.get("indoor"):
+                indoor_sheet.set(store.get("indoor"))
+            if outdoor_sheet.get() is not store.get("outdoor"):
+                outdoor_sheet.set(store.get("outdoor"))
 
     @reactive.Effect
     @reactive.event(input.btn_reload_sheet)
     def _():
         reload_all(
             indoor_sheet=indoor_sheet,
-            outdoor_sheet=outdoor_sheet
+            outdoor_sheet=outdoor_sheet,
+            force=True
         )
 
     dataframe_server(
@@ -129,19 +159,35 @@ def server(input: Inputs, output: Outputs, session: Session):
         "trend_analysis",
         indoor_sheet=indoor_sheet,
         outdoor_sheet=outdoor_sheet,
-        user_sheet=user_sheet
+        user_sheet=user_sheet,
+        memory=memory,
     )
 
     cross_analysis_server(
         "cross_analysis",
         indoor_sheet=indoor_sheet,
+        outdoor_sheet=outdoor_sheet,
+        memory=memory,
+    )
+
+    alerts_server(
+        "alerts",
+        indoor_sheet=indoor_sheet,
         outdoor_sheet=outdoor_sheet
     )
 
 
-app = App(
+shiny_app = App(
     ui=ui_(),
     server=server,
     static_assets=public_dir,
     debug=False
 )
+
+# 資料 API 與 shiny app 共用同一個行程內的表格快取
+app = Starlette(
+    routes=[
+        Mount("/api", app=api),
+        Mount("/", app=shiny_app),
+    ]
+)
@@ -17,8 +17,30 @@ js_path = public_dir / "js" / "main.js"
 
 sheet_config = config.get("sheet")
 
-sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_config.get('id')}"
+# 壓力測試時可以用 url 指向本機的替代 CSV 伺服器（tools/loadtest.py csv-server）
+sheet_url = sheet_config.get(
+    "url", f"https://docs.google.com/spreadsheets/d/{sheet_config.get('id')}")
 
 # sensors dict
 
-sensor_info = config.get("info")
\ No newline at end of file
+sensor_info = config.get("info")
+
+# store configuration
+
+store_config = config.get("store", {})
+
+# derived variable configuration
+
+derived_config = config.get("derived", {})
+
+# alert configuration
+
+alert_config = config.get("alerts", {})
+
+# ingest configuration
+
+ingest_config = config.get("ingest", {})
+
+# session memory configuration
+
+memory_config = config.get("memory", {})
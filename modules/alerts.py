@@ -0,0 +1,134 @@
+from shiny import module, ui, render, reactive, Inputs, Outputs, Session
+from shiny.reactive import Value
+from utils.ui_utils import card, container
+from utils.alert_utils import AlertFeed, EvaluatorLock, create_engine, default_history_path
+from utils.sheet_store import store
+from config import alert_config, sensor_info, store_config
+import pandas as pd
+
+# 全域的規則引擎：每次讀取表格後只評估新增的資料列
+engine = create_engine(alert_config)
+
+# 所有 worker 都從紀錄檔讀取警示，不論是哪個行程發出的
+history_path = alert_config.get("history_path", default_history_path)
+feed = AlertFeed(history_path)
+
+if not store_config.get("shared_memory", False):
+    # 共享記憶體模式由 loader 評估；否則只有取得鎖的 worker 評估
+    evaluator = EvaluatorLock(str(history_path) + ".lock")
+
+    @store.on_refresh
+    def evaluate_alerts(sheets: dict):
+        if not evaluator.acquire():
+            return
+        for location, sheet in sheets.items():
+            engine.evaluate(location, sheet)
+
+
+def describe_rule(rule: dict) -> str:
+    """
+    規則的文字說明
+    """
+    conditions = list()
+    for condition in rule["conditions"]:
+        variable = condition["variable"]
+        if condition.get("rate", False):
+            variable += " 每小時變化量"
+        conditions.append(f"{variable} {condition['op']} {condition['value']}")
+
+    text = " 且 ".join(conditions)
+    if rule.get("duration", 0):
+        text += f" 持續 {rule['duration']} 分鐘"
+    location = rule.get("location")
+    if location is not None:
+        text = sensor_info[location] + "：" + text
+    return text
+
+
+@module.ui
+def alerts_ui():
+    """
+    警示 ui
+
+    """
+    return container(
+        card(
+            ui.h5(
+                {"class": "card-title"},
+                "警示規則",
+            ),
+            ui.tags.ul(
+                *[
+                    ui.tags.li(
+                        ui.tags.strong(rule["name"]),
+                        "：",
+                        describe_rule(rule),
+                    )
+                    for rule in engine.rules
+                ]
+            ) if engine.rules else ui.p("尚未設定警示規則（secrets.toml 的 [alerts]）"),
+        ),
+        ui.navset_tab_card(
+            ui.nav(
+                "觸發紀錄",
+                ui.output_data_frame(id="alerts_df")
+            ),
+        ),
+    ),
+
+
+@module.server
+def alerts_server(
+    input: Inputs,
+    output: Outputs,
+    session: Session,
+    indoor_sheet: Value,
+    outdoor_sheet: Value,
+):
+    """
+    警示 server
+
+    """
+    seen = dict(count=feed.refresh().count)
+
+    # 有新的警示時跳出通知
+    @reactive.Effect
+    def _():
+        indoor_sheet.get()
+        outdoor_sheet.get()
+        reactive.invalidate_later(60)
+
+        feed.refresh()
+        new = min(feed.count - seen["count"], 5)
+        seen["count"] = feed.count
+        if new <= 0:
+            return
+        for alert in list(feed.alerts)[-new:]:
+            ui.notification_show(
+                f"{sensor_info[alert['location']]} {alert['rule']}"
+                f"（{alert['time'].strftime('%Y/%m/%d %H:%M')}）",
+                type="warning",
+                duration=10,
+            )
+
+    @output
+    @render.data_frame
+    def alerts_df():
+        # 重新讀取表格或其他 session 更新表格後都要重新顯示
+        indoor_sheet.get()
+        outdoor_sheet.get()
+        reactive.invalidate_later(60)
+
+        alerts = list(feed.refresh().alerts)
+        alerts.reverse()
+        return pd.DataFrame(
+            {
+                "時間": [i["time"].strftime('%Y/%m/%d %H:%M:%S') for i in alerts],
+                "位置": [sensor_info[i["location"]] for i in alerts],
+                "規則": [i["rule"] for i in alerts],
+                "數值": [
+                    ", ".join(f"{k}={v:g}" for k, v in i["values"].items())
+                    for i in alerts
+                ],
+            }
+        )
@@ -3,9 +3,15 @@ from shiny.reactive import Value
 from shiny import experimental as x
 from shinywidgets import output_widget, render_widget
 from utils.ui_utils import card, container
-from utils.server_utils import get_variables, get_date_range, collapse_soil_cols
+from utils.server_utils import get_variables, collapse_soil_cols
+from utils.sheet_store import store
+from utils.plot_utils import compact_values, stratified_sample
+from utils.regression_utils import fit_by_month, fit_moments, merge_moments
+from utils.reactive_utils import debounce
+from utils.memory_utils import SessionMemory
 from config import sensor_info
 from plotly import graph_objects as go
+import pandas as pd
 
 
 @module.ui
@@ -94,9 +100,52 @@ def cross_analysis_ui():
             x.ui.card_title(
                 "散佈圖"
             ),
+            ui.div(
+                {"class": "d-flex gap-3"},
+                ui.input_checkbox(
+                    id="show_fit",
+                    label="迴歸線",
+                    value=True,
+                ),
+                ui.input_checkbox(
+                    id="fit_by_month",
+                    label="依月份分別擬合",
+                    value=False,
+                ),
+            ),
             output_widget(id="cross_analysis", height="auto"),
             full_screen=True,
         ),
+        x.ui.card(
+            x.ui.card_title(
+                "散佈矩陣"
+            ),
+            ui.row(
+                ui.column(
+                    9,
+                    ui.input_selectize(
+                        id="splom_variables",
+                        label="變數（可跨位置，使用上方的頻率與測量區間）",
+                        choices=[],
+                        multiple=True,
+                        width="100%",
+                    ),
+                ),
+                ui.column(
+                    3,
+                    ui.input_numeric(
+                        id="splom_budget",
+                        label="點數上限",
+                        value=2000,
+                        min=100,
+                        max=20000,
+                        step=100,
+                    ),
+                ),
+            ),
+            output_widget(id="splom", height="auto"),
+            full_screen=True,
+        ),
     )
 
 
@@ -107,12 +156,20 @@ def cross_analysis_server(
     session: Session,
     indoor_sheet: Value,
     outdoor_sheet: Value,
+    memory: SessionMemory,
 ):
     """
     交叉分析 server
     
     """
 
+    def depend_on_sheets():
+        """
+        讀取兩個位置的 reactive value，重新讀取表格時更新
+        """
+        indoor_sheet.get()
+        outdoor_sheet.get()
+
     @reactive.Effect
     @reactive.event(input.cross_analysis_sensor_1)
     def _():
@@ -123,7 +180,7 @@ def cross_analysis_server(
         else:
             df = outdoor_sheet.get()
 
-        variables = collapse_soil_cols(get_variables(df))
+        variables = collapse_soil_cols(get_variables(df, derived=True))
         ui.update_selectize(
             id="cross_analysis_var_1",
             choices=variables,
@@ -140,7 +197,7 @@ def cross_analysis_server(
         else:
             df = outdoor_sheet.get()
 
-        variables = get_variables(df)
+        variables = get_variables(df, derived=True)
         ui.update_selectize(
             id="cross_analysis_var_2",
             choices=variables,
@@ -153,20 +210,8 @@ def cross_analysis_server(
         location1 = input.cross_analysis_sensor_1()
         location2 = input.cross_analysis_sensor_2()
 
-        df1, df2 = None, None
-
-        if location1 == "indoor":
-            df1 = indoor_sheet.get()
-        else:
-            df1 = outdoor_sheet.get()
-
-        if location2 == "indoor":
-            df2 = indoor_sheet.get()
-        else:
-            df2 = outdoor_sheet.get()
-
-        m1, M1 = get_date_range(df1)
-        m2, M2 = get_date_range(df2)
+        m1, M1 = store.date_range(location1)
+        m2, M2 = store.date_range(location2)
 
         m = max(m1, m2)
         M = min(M1, M2)
@@ -179,66 +224,215 @@ def cross_analysis_server(
             max=M,
         )
 
+    # 切換位置時會連帶更新變數與日期區間，等這些輸入都穩定後才重畫一次
+    @debounce(.5)
+    def scatter_inputs():
+        memory.touch()
+        return (
+            input.cross_analysis_sensor_1(),
+            input.cross_analysis_sensor_2(),
+            input.cross_analysis_var_1(),
+            input.cross_analysis_var_2(),
+            input.frequency_select_alt(),
+            input.input_date_range_alt(),
+        )
+
+    scatter_widget = reactive.Value(None)
+
     @output
     @render_widget
     def cross_analysis():
-        with reactive.isolate():
-            location1 = input.cross_analysis_sensor_1()
-            location2 = input.cross_analysis_sensor_2()
+        fig = go.FigureWidget(
+            data=[go.Scattergl(x=[], y=[], mode='markers', showlegend=False)]
+        )
+        fig.update_layout(
+            autosize=True,
+            height=350,
+            margin={
+                "t": 0,
+                "b": 0
+            }
+        )
+        scatter_widget.set(memory.widget("scatter", fig))
+        return fig
 
-        fig = go.Figure()
-        column1 = input.cross_analysis_var_1()
-        column2 = input.cross_analysis_var_2()
+    # 依輸入就地更新散佈圖的資料與軸標題
+    @reactive.Effect
+    def _():
+        fig = scatter_widget.get()
+        if fig is None:
+            return
+
+        location1, location2, column1, column2, frequency, (m, M) = \
+            scatter_inputs()
 
 
         var1_label_name = sensor_info[location1] + column1
         var2_label_name = sensor_info[location2] + column2
 
 
-        df1, df2 = None, None
+        depend_on_sheets()
 
-        if location1 == "indoor":
-            df1 = indoor_sheet.get()
-        else:
-            df1 = outdoor_sheet.get()
+        x_, y_ = [], []
+        try:
+            df1 = store.select(location1, frequency, m, M, [column1])
+            df2 = store.select(location2, frequency, m, M, [column2])
 
-        if location2 == "indoor":
-            df2 = indoor_sheet.get()
-        else:
-            df2 = outdoor_sheet.get()
+            # 依時間對齊兩個變數
+            x_, y_ = df1.set_index('時間')[column1].align(
+                df2.set_index('時間')[column2], join="inner")
+            x_, y_ = compact_values(x_), compact_values(y_)
+        except KeyError as e:
+            pass
+
+        with fig.batch_update():
+            fig.data[0].x = x_
+            fig.data[0].y = y_
+            fig.update_layout(
+                xaxis_title=var1_label_name,
+                yaxis_title=var2_label_name,
+            )
 
-        m, M = input.input_date_range_alt()
-        mask1 = ((df1['時間'].dt.date >= m) & (df1['時間'].dt.date <= M))
-        df1 = df1.loc[mask1]
-        mask2 = ((df2['時間'].dt.date >= m) & (df2['時間'].dt.date <= M))
-        df2 = df2.loc[mask2]
+    # 迴歸線由每日的部分和合併而來，切換區間或月份時不需重新讀取資料列
+    @reactive.Effect
+    def _():
+        fig = scatter_widget.get()
+        if fig is None:
+            return
 
-        if input.frequency_select_alt() == "hour":
-            df1 = df1.resample('H', on='時間').mean()
-            df2 = df2.resample('H', on='時間').mean()
-        elif input.frequency_select_alt() == "day":
-            df1 = df1.resample('D', on='時間').mean()
-            df2 = df2.resample('D', on='時間').mean()
+        location1, location2, column1, column2, frequency, (m, M) = \
+            scatter_inputs()
+        show_fit = input.show_fit()
+        by_month = input.fit_by_month()
 
-        try:
-            fig.add_trace(
-                go.Scatter(
-                    x=df1[column1],
-                    y=df2[column2],
-                    mode='markers'
-                )
+        depend_on_sheets()
+
+        fits = dict()
+        if show_fit:
+            try:
+                moments = store.pair_moments(
+                    location1, column1, location2, column2, frequency)
+                moments = moments.loc[pd.Timestamp(m):pd.Timestamp(M)]
+            except KeyError:
+                moments = None
+
+            if moments is not None and not moments.empty:
+                if by_month:
+                    fits = fit_by_month(moments)
+                else:
+                    fit = fit_moments(merge_moments(moments))
+                    if fit is not None:
+                        fits["全部"] = fit
+
+        traces = list()
+        for label, fit in fits.items():
+            xs = [fit["xmin"], fit["xmax"]]
+            sign = "+" if fit["intercept"] >= 0 else "-"
+            traces.append(go.Scattergl(
+                x=xs,
+                y=[fit["slope"] * i + fit["intercept"] for i in xs],
+                mode="lines",
+                name=f"{label}：y = {fit['slope']:.3g}x {sign} {abs(fit['intercept']):.3g}，"
+                     f"R² = {fit['r2']:.3f}（n = {fit['n']}）",
+            ))
+
+        with fig.batch_update():
+            fig.data = fig.data[:1]
+            for trace in traces:
+                fig.add_trace(trace)
+            fig.update_layout(
+                showlegend=bool(traces),
+                legend={"x": .01, "y": .99, "bgcolor": "rgba(255, 255, 255, .6)"},
             )
-        except KeyError as e:
-            pass
 
+    @reactive.Effect
+    def _():
+        choices = dict()
+        for location, df in [("indoor", indoor_sheet.get()),
+                             ("outdoor", outdoor_sheet.get())]:
+            for variable in get_variables(df, derived=True):
+                choices[f"{location}:{variable}"] = \
+                    sensor_info[location] + " " + variable
+
+        with reactive.isolate():
+            selected = [i for i in (input.splom_variables() or [])
+                        if i in choices]
+        ui.update_selectize(
+            id="splom_variables",
+            choices=choices,
+            selected=selected,
+        )
+
+    @debounce(.5)
+    def splom_inputs():
+        memory.touch()
+        return (
+            tuple(input.splom_variables() or []),
+            input.frequency_select_alt(),
+            input.input_date_range_alt(),
+            input.splom_budget(),
+        )
+
+    splom_widget = reactive.Value(None)
+
+    @output
+    @render_widget
+    def splom():
+        fig = go.FigureWidget(
+            data=[go.Splom(
+                dimensions=[],
+                showupperhalf=False,
+                diagonal_visible=False,
+                marker={"size": 3, "opacity": .5},
+            )]
+        )
         fig.update_layout(
             autosize=True,
             height=350,
-            xaxis_title=var1_label_name,
-            yaxis_title=var2_label_name,
             margin={
-                "t": 0,
-                "b": 0
-            }
+                "t": 20,
+                "b": 20
+            },
+            dragmode="select",
         )
+        splom_widget.set(memory.widget("splom", fig))
         return fig
+
+    # 所有選取的變數依時間對齊後分層抽樣，整個矩陣在一次更新中送出
+    @reactive.Effect
+    def _():
+        fig = splom_widget.get()
+        if fig is None:
+            return
+
+        variables, frequency, (m, M), budget = splom_inputs()
+
+        depend_on_sheets()
+
+        columns = dict()
+        for i in variables:
+            location, variable = i.split(":", 1)
+            columns.setdefault(location, list()).append(variable)
+
+        dimensions = list()
+        if len(variables) >= 2:
+            frames = [
+                store.select(location, frequency, m, M, names)
+                .set_index('時間')
+                .rename(columns=lambda name: f"{location}:{name}")
+                for location, names in columns.items()
+            ]
+            df = pd.concat(frames, axis=1, join="inner").dropna(how="all")
+            df = stratified_sample(df, int(budget or 2000),
+                                   df.index.to_series())
+
+            for i in variables:
+                location, variable = i.split(":", 1)
+                dimensions.append({
+                    "label": sensor_info[location] + " " + variable,
+                    "values": compact_values(df[i].rename(variable)),
+                })
+
+        with fig.batch_update():
+            fig.data[0].dimensions = dimensions
+            fig.update_layout(height=max(350, 150 * len(dimensions)))
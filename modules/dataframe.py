@@ -1,7 +1,13 @@
-from shiny import module, ui, render, Inputs, Outputs, Session
+from shiny import module, ui, render, reactive, Inputs, Outputs, Session
 from shiny.reactive import Value
 from utils.ui_utils import container
-from utils.server_utils import convert_epoch_to_strftime
+from utils.server_utils import (
+    convert_epoch_to_strftime,
+    get_date_range,
+    summarize_daily_statistics,
+)
+from utils.sheet_store import store
+from config import sensor_info
 import pandas as pd
 
 
@@ -20,17 +26,35 @@ def dataframe_ui():
             ui.nav(
                 "室外",
                 ui.output_data_frame(id="outdoor_df")
-            )
+            ),
+            ui.nav(
+                "每日統計",
+                ui.row(
+                    ui.column(
+                        6,
+                        ui.input_date_range(
+                            id="stats_date_range",
+                            label="統計區間",
+                            separator=" 至 ",
+                            language="zh-TW",
+                        ),
+                    ),
+                    ui.column(
+                        6,
+                        ui.input_radio_buttons(
+                            id="stats_mode",
+                            label="顯示方式",
+                            choices={
+                                "summary": "區間彙總",
+                                "daily": "每日",
+                            },
+                            inline=True,
+                        ),
+                    ),
+                ),
+                ui.output_data_frame(id="stats_df"),
+            ),
         ),
-        # panel_box(
-        #     ui.h5(
-        #         {"class": "card-title"},
-        #         "資料框非缺失值統計",
-        #     ),
-        #     ui.output_text_verbatim(
-        #         id="sheet_info",
-        #     )
-        # )
     ),
 
 
@@ -47,23 +71,53 @@ def dataframe_server(
 
     """
 
-    # @output
-    # @render.text
-    # def sheet_info():
-    #     buffer = io.StringIO()
-    #     sheet.get().info(buf=buffer)
-    #     return buffer.getvalue()
-
     @output
     @render.data_frame
     def indoor_df():
         df = indoor_sheet.get()
-        df.sort_values(by="時間", ascending=False, inplace=True)
+        df = df.sort_values(by="時間", ascending=False)
         return convert_epoch_to_strftime(df)
 
     @output
     @render.data_frame
     def outdoor_df():
         df = outdoor_sheet.get()
-        df.sort_values(by="時間", ascending=False, inplace=True)
+        df = df.sort_values(by="時間", ascending=False)
         return convert_epoch_to_strftime(df)
+
+    @reactive.Effect
+    def _():
+        ranges = [get_date_range(indoor_sheet.get()),
+                  get_date_range(outdoor_sheet.get())]
+        m = min(i[0] for i in ranges)
+        M = max(i[1] for i in ranges)
+
+        ui.update_date_range(
+            id="stats_date_range",
+            start=m,
+            end=M,
+            min=m,
+            max=M,
+        )
+
+    # 每日統計依表格版本只計算一次，選取區間時只切片每日的結果
+    @output
+    @render.data_frame
+    def stats_df():
+        indoor_sheet.get()
+        outdoor_sheet.get()
+        m, M = input.stats_date_range()
+
+        frames = list()
+        for location in store.locations:
+            daily = store.daily_statistics(location)
+            dates = daily['日期']
+            daily = daily.loc[(dates >= pd.Timestamp(m)) & (dates <= pd.Timestamp(M))]
+            if input.stats_mode() == "summary":
+                daily = summarize_daily_statistics(daily)
+            else:
+                daily = daily.assign(日期=daily['日期'].dt.strftime('%Y/%m/%d'))
+            daily.insert(0, '位置', sensor_info[location])
+            frames.append(daily.drop(columns='資料列數'))
+
+        return pd.concat(frames, ignore_index=True).round(3)
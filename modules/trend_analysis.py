@@ -1,15 +1,21 @@
-from shiny import ui, module, Inputs, Outputs, Session, reactive
+from shiny import ui, module, render, req, Inputs, Outputs, Session, reactive
 from shiny.reactive import Value
 from shiny import experimental as x
 from shinywidgets import output_widget, render_widget
 from utils.ui_utils import card, container
 from utils.server_utils import collapse_soil_cols, get_date_range, get_variables, expand_soil_cols
+from utils.sheet_store import store
+from utils.plot_utils import compact_time, compact_values, soil_sensor_figure, sync_traces
+from utils.reactive_utils import debounce
+from utils.memory_utils import SessionMemory
+from utils.rain_utils import event_response, has_rain, slice_events
 from config import sensor_info
 from plotly import (
     express as px,
     graph_objects as go,
 )
 from plotly.subplots import make_subplots
+import pandas as pd
 
 
 @module.ui
@@ -77,6 +83,11 @@ def trend_analysis_ui():
                         multiple=True,
                         width="100%"
                     ),
+                    ui.input_checkbox(
+                        id="show_rain",
+                        label="標示降雨事件",
+                        value=True,
+                    ),
                 )
             ),
             class_="mb-3",
@@ -90,6 +101,44 @@ def trend_analysis_ui():
             ),
             full_screen=True,
         ),
+        x.ui.card(
+            x.ui.card_title(
+                "土壤感測器比較"
+            ),
+            output_widget(
+                id="soil_sensor_plot",
+            ),
+            full_screen=True,
+        ),
+        x.ui.card(
+            x.ui.card_title(
+                "降雨事件後的土壤濕度"
+            ),
+            ui.div(
+                {"class": "d-flex gap-3"},
+                ui.input_selectize(
+                    id="rain_response_column",
+                    label="土壤濕度感測器",
+                    choices=[],
+                ),
+                ui.input_radio_buttons(
+                    id="rain_response_hours",
+                    label="事件開始後",
+                    choices={
+                        "12": "12 小時",
+                        "24": "24 小時",
+                        "48": "48 小時",
+                    },
+                    selected="24",
+                    inline=True,
+                ),
+            ),
+            output_widget(
+                id="rain_response_plot",
+            ),
+            ui.output_data_frame(id="rain_events_df"),
+            full_screen=True,
+        ),
     ),
 
 
@@ -119,13 +168,30 @@ def trend_analysis_server(
     session: Session,
     indoor_sheet: Value,
     outdoor_sheet: Value,
-    user_sheet: Value
+    user_sheet: Value,
+    memory: SessionMemory,
 ):
     """
     趨勢圖分析 server
 
     """
 
+    def depend_on_sheet(location):
+        """
+        讀取該位置的 reactive value，重新讀取表格時更新
+        """
+        if location == "indoor":
+            indoor_sheet.get()
+        else:
+            outdoor_sheet.get()
+
+    def depend_on_sheets():
+        """
+        讀取兩個位置的 reactive value，重新讀取表格時更新
+        """
+        indoor_sheet.get()
+        outdoor_sheet.get()
+
     @reactive.Effect
     @reactive.event(input.sensor_location)
     def _():
@@ -136,7 +202,7 @@ def trend_analysis_server(
         else:
             df = outdoor_sheet.get()
 
-        m, M = get_date_range(df)
+        m, M = store.date_range(location)
 
         ui.update_date_range(
             id="input_date_range",
@@ -145,60 +211,263 @@ def trend_analysis_server(
             min=m,
             max=M,
         )
-        variables = collapse_soil_cols(get_variables(df))
+        variables = collapse_soil_cols(get_variables(df, derived=True))
         ui.update_selectize(
             id="variable_select",
             choices=variables,
             selected=variables[1]
         )
 
+    # 拖曳日期區間或連續選取變數時，只在輸入停止變動後計算一次
+    @debounce(.5)
+    def user_inputs():
+        memory.touch()
+        return (
+            input.sensor_location(),
+            input.frequency_select(),
+            input.input_date_range(),
+            input.variable_select(),
+        )
+
+    # 土壤感測器比較圖只依位置、頻率與區間更新，與選取的變數無關
+    @debounce(.5)
+    def soil_inputs():
+        memory.touch()
+        return (
+            input.sensor_location(),
+            input.frequency_select(),
+            input.input_date_range(),
+        )
+
     @reactive.Calc
+    def user_sheet_key():
+        location, frequency, date_range, variables = user_inputs()
+
+        depend_on_sheet(location)
+
+        return location, frequency, date_range, tuple(variables), store.version
+
+    # 資料框不快取在 reactive calc 中，閒置時可以丟棄，需要時再重新計算
     def set_user_sheet():
-        location = input.sensor_location()
-        m, M = input.input_date_range()
-        new_cols = ['時間', '原本的時間'] + \
-            list(expand_soil_cols(input.variable_select()))
+        location, frequency, (m, M), variables, _ = key = user_sheet_key()
 
-        df = None
-        if location == "indoor":
-            df = indoor_sheet.get().copy()
-        else:
-            df = outdoor_sheet.get().copy()
-
-        mask = ((df['時間'].dt.date >= m) & (df['時間'].dt.date <= M))
-        df = df.loc[mask]
-        df['原本的時間'] = df['時間']
-
-        if input.frequency_select() == "hour":
-            df = df.resample('H', on='時間').mean()
-            df['時間'] = df.index.strftime('%Y/%m/%d %H:%M')
-        elif input.frequency_select() == "day":
-            df = df.resample('D', on='時間').mean()
-            df['時間'] = df.index.strftime('%Y/%m/%d')
-        else:
-            df['時間'] = df['時間'].dt.strftime('%Y/%m/%d %H:%M:%S')
+        def compute():
+            new_cols = ['時間', '原本的時間'] + \
+                list(expand_soil_cols(variables))
+
+            df = store.select(location, frequency, m, M,
+                              list(expand_soil_cols(variables)))
+            df['原本的時間'] = df['時間']
+
+            if frequency == "hour":
+                df['時間'] = df['時間'].dt.strftime('%Y/%m/%d %H:%M')
+            elif frequency == "day":
+                df['時間'] = df['時間'].dt.strftime('%Y/%m/%d')
+            else:
+                df['時間'] = df['時間'].dt.strftime('%Y/%m/%d %H:%M:%S')
+
+            df = df[new_cols]
+            user_sheet.set(df)
+            print("user sheet has been set.")
+            return df
+
+        return memory.cached("user_sheet", key, compute)
 
-        df = df[new_cols]
-        user_sheet.set(df)
-        print("user sheet has been set.")
-        return df
+    forecast_suffix = "（預測）"
+
+    def is_forecast(trace):
+        return str(trace.name).endswith(forecast_suffix)
+
+    trend_widget = reactive.Value(None)
+    trend_key = dict()
 
     @output
     @render_widget
     def user_select_time_variable_plot():
-        fig = go.Figure()
+        fig = go.FigureWidget()
+        fig.update_layout(
+            autosize=True,
+            xaxis_type="date",
+            height=350,
+            margin={
+                "t": 0,
+                "b": 0
+            },
+        )
+        trend_widget.set(memory.widget("trend", fig))
+        return fig
+
+    # 依輸入更新趨勢圖，只傳送有變動的 trace
+    @reactive.Effect
+    def _():
+        fig = trend_widget.get()
+        if fig is None:
+            return
+
         df = set_user_sheet()
         columns = df.drop(["時間", "原本的時間"], axis=1).columns.tolist()
 
-        for i, column in enumerate(columns):
-            fig.add_trace(
-                go.Scatter(
-                    y=df[column],
-                    x=df["原本的時間"],
-                    name=column
-                ),
-            )
+        location, frequency, date_range, _ = user_inputs()
+        key = (location, frequency, date_range, store.version)
+        refresh = trend_key.get("data") != key
+        trend_key["data"] = key
+
+        sync_traces(
+            fig,
+            x=compact_time(df["原本的時間"]),
+            columns={column: compact_values(df[column]) for column in columns},
+            refresh=refresh,
+            make_trace=go.Scattergl,
+            keep=is_forecast,
+        )
+
+    # 土壤濕度預測以虛線接在觀測值之後；模型依表格版本只更新一次，所有 session 共用
+    @reactive.Effect
+    def _():
+        fig = trend_widget.get()
+        if fig is None:
+            return
+
+        location, _, (m, M), variables = user_inputs()
+
+        depend_on_sheet(location)
+
+        columns = [i for i in expand_soil_cols(variables)
+                   if i.startswith("土壤濕度")]
+        traces = list()
+        if columns and M >= get_date_range(store.get(location))[1]:
+            forecast = store.forecast(location)
+            for column in columns:
+                if column not in forecast.columns:
+                    continue
+                curve = forecast[['時間', column]].dropna()
+                if not curve.empty:
+                    traces.append(go.Scattergl(
+                        x=compact_time(curve['時間']),
+                        y=compact_values(curve[column]),
+                        name=column + forecast_suffix,
+                        mode="lines",
+                        line_dash="dash",
+                    ))
+
+        # 同一個表格版本只增減預測線，不重送已經畫出的預測
+        key = (location, store.version)
+        refresh = trend_key.get("forecast") != key
+        trend_key["forecast"] = key
+
+        names = [t.name for t in traces]
+        existing = [t.name for t in fig.data if is_forecast(t)]
+        with fig.batch_update():
+            kept = tuple(t for t in fig.data
+                         if not is_forecast(t) or (not refresh and t.name in names))
+            if len(kept) != len(fig.data):
+                fig.data = kept
+            for trace in traces:
+                if refresh or trace.name not in existing:
+                    fig.add_trace(trace)
+
+    @output
+    @render_widget
+    def soil_sensor_plot():
+        location, frequency, (m, M) = soil_inputs()
+
+        depend_on_sheet(location)
+
+        soil_cols = [i for i in get_variables(store.get(location))
+                     if i.startswith("土壤")]
+        df = store.select(location, frequency, m, M, soil_cols)
+        fig = go.FigureWidget(soil_sensor_figure(df, make_trace=go.Scattergl))
+        # 關閉上一次繪製的 widget，避免舊的圖表資料一直留在記憶體
+        return memory.widget("soil_sensor_plot", fig)
 
+    # 依降雨事件表在趨勢圖上標示降雨期間，只更新圖表的 shapes
+    @reactive.Effect
+    def _():
+        fig = trend_widget.get()
+        if fig is None:
+            return
+
+        location, _, (m, M), _ = user_inputs()
+        show_rain = input.show_rain()
+
+        depend_on_sheet(location)
+
+        shapes = list()
+        if show_rain:
+            events = slice_events(store.rain_events(location), m, M)
+            shapes = [
+                {
+                    "type": "rect",
+                    "xref": "x",
+                    "yref": "paper",
+                    "x0": start.isoformat(),
+                    "x1": (end + pd.Timedelta(minutes=5)).isoformat(),
+                    "y0": 0,
+                    "y1": 1,
+                    "fillcolor": "rgba(31, 119, 180, .15)",
+                    "line_width": 0,
+                    "layer": "below",
+                }
+                for start, end in zip(events['開始'], events['結束'])
+            ]
+
+        with fig.batch_update():
+            fig.layout.shapes = shapes
+
+    def rain_location():
+        """
+        有雨量計的位置
+        """
+        for location in store.locations:
+            if has_rain(store.get(location)):
+                return location
+        return None
+
+    @reactive.Effect
+    def _():
+        depend_on_sheets()
+        location = rain_location()
+        if location is None:
+            return
+
+        columns = [i for i in get_variables(store.get(location))
+                   if i.startswith("土壤濕度")]
+        ui.update_selectize(
+            id="rain_response_column",
+            choices=columns,
+            selected=columns[0] if columns else None,
+        )
+
+    # 只切取每個降雨事件前後的資料列，不需掃描整段序列
+    @reactive.Calc
+    def rain_response():
+        _, _, (m, M) = soil_inputs()
+        column = input.rain_response_column()
+        hours = int(input.rain_response_hours())
+
+        depend_on_sheets()
+
+        location = rain_location()
+        req(location, column)
+
+        events = slice_events(store.rain_events(location), m, M)
+        curves, summary = event_response(
+            store.get(location), events, column, hours)
+        return column, events, curves, summary
+
+    @output
+    @render_widget
+    def rain_response_plot():
+        column, events, curves, _ = rain_response()
+
+        fig = go.Figure()
+        for start, curve in curves.items():
+            fig.add_trace(go.Scattergl(
+                x=curve.index.to_numpy(),
+                y=compact_values(curve.rename(column)),
+                mode="lines",
+                name=f"{start:%m/%d %H:%M}（{events.loc[start, '總雨量']:.1f} mm）",
+            ))
         fig.update_layout(
             autosize=True,
             height=350,
@@ -206,8 +475,22 @@ def trend_analysis_server(
                 "t": 0,
                 "b": 0
             },
+            xaxis_title="事件開始後時數",
+            yaxis_title=column + " 變化量",
         )
-        return fig
+        return memory.widget("rain_response_plot", go.FigureWidget(fig))
+
+    @output
+    @render.data_frame
+    def rain_events_df():
+        _, events, _, summary = rain_response()
+
+        df = events.reset_index(drop=True)
+        if not summary.empty:
+            df = df.merge(summary, on='開始', how="left")
+        df['開始'] = df['開始'].dt.strftime('%Y/%m/%d %H:%M')
+        df['結束'] = df['結束'].dt.strftime('%Y/%m/%d %H:%M')
+        return df.round(2)
 
 
 @module.server
@@ -0,0 +1,106 @@
+"""
+模擬感測器閘道，定期把假的量測值推送到 /api/ingest/{location}
+
+python tools/fake_gateway.py --url http://127.0.0.1:8000 --token <token>
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.server_utils import get_sheet_columns  # noqa: E402
+
+# 各變數的大致範圍，用來產生隨機漫步的初始值
+typical = {
+    "氣壓": 1010,
+    "氣溫": 25,
+    "空氣相對溼度": 70,
+    "光強度": 20000,
+    "風向": 180,
+    "風速": .5,
+    "土壤溫度": 24,
+    "土壤濕度": 35,
+    "土壤電導度": 300,
+}
+
+
+def initial_value(column: str) -> float:
+    for prefix, value in typical.items():
+        if column.startswith(prefix):
+            return value
+    return 0.
+
+
+def make_rows(location: str, state: dict, start: datetime, count: int, step: timedelta) -> list:
+    """
+    產生 count 筆隨機漫步的資料列
+    """
+    rows = list()
+    for i in range(count):
+        row = {"時間": (start + step * i).strftime("%Y-%m-%d %H:%M:%S")}
+        for column in get_sheet_columns(location):
+            value = state.setdefault(column, initial_value(column))
+            value = max(0., value + random.gauss(0, abs(value) * .01 + .1))
+            state[column] = value
+            row[column] = round(value, 2)
+        rows.append(row)
+    return rows
+
+
+def push(url: str, token: str, location: str, rows: list) -> dict:
+    request = urllib.request.Request(
+        f"{url}/api/ingest/{location}",
+        data=json.dumps({"rows": rows}, ensure_ascii=False).encode(),
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        },
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--location", action="append",
+                        help="可重複指定，預設 indoor 與 outdoor")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="每次推送間隔的秒數")
+    parser.add_argument("--batch", type=int, default=12,
+                        help="每次推送的資料列數")
+    parser.add_argument("--step", type=int, default=300,
+                        help="資料列之間的時間間隔（秒）")
+    parser.add_argument("--count", type=int, default=0,
+                        help="推送次數，0 表示不停推送")
+    args = parser.parse_args()
+
+    locations = args.location or ["indoor", "outdoor"]
+    step = timedelta(seconds=args.step)
+    states = {location: dict() for location in locations}
+    start = datetime.now().replace(microsecond=0)
+
+    n = 0
+    while args.count == 0 or n < args.count:
+        for location in locations:
+            rows = make_rows(location, states[location], start, args.batch, step)
+            try:
+                print(location, push(args.url, args.token, location, rows))
+            except urllib.error.HTTPError as e:
+                print(location, e.code, e.read().decode())
+        start += step * args.batch
+        n += 1
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
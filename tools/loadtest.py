@@ -0,0 +1,462 @@
+"""
+儀表板壓力測試：同時模擬多個 shiny session
+
+1. 啟動替代 CSV 伺服器，並在 secrets.toml 的 [sheet] 加上 url = "http://127.0.0.1:8800"
+
+    python tools/loadtest.py csv-server --port 8800
+
+2. 啟動儀表板（或在 run 加上 --spawn 由本工具啟動）
+
+    uvicorn app:app --port 8000
+
+3. 模擬 session，回報首次繪製與互動的延遲百分位數與每個 session 的記憶體用量
+
+    python tools/loadtest.py run --url http://127.0.0.1:8000 --sessions 30 --pid <server pid>
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import websockets
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import root_dir, sensor_info, sheet_config  # noqa: E402
+from utils.server_utils import collapse_soil_cols, get_sheet_columns  # noqa: E402
+
+# 與 app.py 的 module id 對應
+trend_outputs = [
+    "trend_analysis-user_select_time_variable_plot",
+    "trend_analysis-soil_sensor_plot",
+]
+cross_outputs = ["cross_analysis-cross_analysis", "cross_analysis-splom"]
+dataframe_outputs = ["dataframe-indoor_df", "dataframe-outdoor_df", "dataframe-stats_df"]
+all_outputs = trend_outputs + cross_outputs + dataframe_outputs + ["alerts-alerts_df"]
+
+frequencies = ["default", "hour", "day"]
+
+
+# 替代 CSV 伺服器
+
+
+def make_sheet(location: str, days: int, seed: int = 0) -> pd.DataFrame:
+    """
+    產生與 Google 表格匯出格式相同的合成資料，結束於現在
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp.now().floor("5min")
+    t = pd.date_range(end=end, periods=days * 288, freq="5min")
+    hour = t.hour.to_numpy() + t.minute.to_numpy() / 60
+    daily = np.sin((hour - 9) / 24 * 2 * np.pi)
+
+    df = pd.DataFrame({"時間": t.strftime("%Y-%m-%d %H:%M:%S")})
+    for column in get_sheet_columns(location):
+        base = rng.uniform(10, 40)
+        noise = rng.normal(0, 1, len(t)).cumsum() * .05
+        df[column] = np.round(base + 5 * daily + noise, 2)
+    # 模擬感測器回傳的缺失值
+    column = df.columns[1]
+    missing = rng.random(len(t)) < .002
+    df[column] = df[column].astype(str).mask(missing, "999")
+    return df
+
+
+class CSVHandler(BaseHTTPRequestHandler):
+    """
+    以 /export?format=csv&gid=<gid> 回應表格，gid 依 secrets.toml 的 [sheet] 對應位置
+    """
+    directory = Path(".")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        gid = parse_qs(url.query).get("gid", [None])[0]
+        locations = {str(sheet_config.get(i)): i for i in sensor_info}
+        if not url.path.endswith("/export") or gid not in locations:
+            self.send_error(404)
+            return
+
+        body = (self.directory / f"{locations[gid]}.csv").read_bytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def csv_server(args):
+    directory = Path(args.dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    for i, location in enumerate(sensor_info):
+        path = directory / f"{location}.csv"
+        if args.regenerate or not path.exists():
+            make_sheet(location, args.days, seed=i).to_csv(path, index=False)
+            print(f"generated {path}")
+
+    CSVHandler.directory = directory
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), CSVHandler)
+    print(f"serving {directory} on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+# 模擬 session
+
+
+def read_rss(pid: int) -> int:
+    """
+    行程的常駐記憶體（bytes），只支援 Linux
+    """
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def fetch_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return json.loads(response.read())
+
+
+def fetch_index(url: str) -> dict:
+    return fetch_json(f"{url}/api/")
+
+
+def random_range(start: date, end: date, max_days: int = 14) -> list:
+    days = (end - start).days
+    length = random.randint(0, min(days, max_days))
+    m = start + timedelta(days=random.randint(0, days - length))
+    return [m.isoformat(), (m + timedelta(days=length)).isoformat()]
+
+
+def hidden(outputs: list) -> dict:
+    """
+    只有顯示中的分頁的輸出會被繪製
+    """
+    return {
+        f".clientdata_output_{i}_hidden": i not in outputs
+        for i in all_outputs
+    }
+
+
+class SimulatedSession:
+    """
+    一個瀏覽器分頁：開啟趨勢圖，依序操作趨勢圖、交叉分析與資料框分頁
+    """
+
+    def __init__(self, url: str, index: dict, steps: int, think: float, settle: float):
+        self.ws_url = url.replace("http", "ws", 1) + "/websocket/"
+        self.host = urlparse(url)
+        self.locations = index["locations"]
+        self.steps = steps
+        self.think = think
+        self.settle = settle
+        self.first_render = None
+        self.interactions = list()
+        self.errors = list()
+        self.finished = asyncio.Event()
+
+    def variables(self, location: str, k: int) -> list:
+        variables = collapse_soil_cols(self.locations[location]["variables"])
+        return random.sample(variables, min(k, len(variables)))
+
+    def splom_variables(self, k: int = 3) -> list:
+        """
+        散佈矩陣的變數，格式為 位置:變數，可跨位置
+        """
+        variables = [f"{location}:{variable}"
+                     for location, info in self.locations.items()
+                     for variable in info["variables"]]
+        return random.sample(variables, min(k, len(variables)))
+
+    def date_range(self, location: str) -> list:
+        info = self.locations[location]
+        return random_range(date.fromisoformat(info["start"]),
+                            date.fromisoformat(info["end"]))
+
+    def initial_inputs(self) -> dict:
+        location = self.location = random.choice(list(self.locations))
+        data = {
+            ".clientdata_url_search": "",
+            ".clientdata_url_hash_initial": "",
+            ".clientdata_url_protocol": self.host.scheme + ":",
+            ".clientdata_url_hostname": self.host.hostname,
+            ".clientdata_url_port": str(self.host.port or ""),
+            ".clientdata_url_pathname": "/",
+            "btn_reload_sheet:shiny.action": 0,
+            "trend_analysis-sensor_location": location,
+            "trend_analysis-frequency_select": random.choice(frequencies),
+            "trend_analysis-input_date_range:shiny.date": self.date_range(location),
+            "trend_analysis-variable_select": self.variables(location, 2),
+            "cross_analysis-cross_analysis_sensor_1": "indoor",
+            "cross_analysis-cross_analysis_sensor_2": "outdoor",
+            "cross_analysis-cross_analysis_var_1": "氣溫",
+            "cross_analysis-cross_analysis_var_2": "氣溫",
+            "cross_analysis-frequency_select_alt": "hour",
+            "cross_analysis-input_date_range_alt:shiny.date": self.date_range("indoor"),
+            "cross_analysis-splom_variables": self.splom_variables(),
+            "cross_analysis-splom_budget": 2000,
+            "dataframe-stats_mode": "summary",
+            "dataframe-stats_date_range:shiny.date": self.date_range("indoor"),
+        }
+        data.update(hidden(trend_outputs))
+        return data
+
+    def scenario(self) -> list:
+        """
+        (名稱, 輸入) 的操作序列
+        """
+        actions = list()
+        location = self.location
+        for _ in range(self.steps):
+            if random.random() < .25:
+                location = random.choice(list(self.locations))
+                actions.append(("trend: location", {
+                    "trend_analysis-sensor_location": location,
+                    "trend_analysis-variable_select": self.variables(location, 2)}))
+                continue
+            actions.append(random.choice([
+                ("trend: variables", {
+                    "trend_analysis-variable_select": self.variables(location, random.randint(1, 4))}),
+                ("trend: frequency", {
+                    "trend_analysis-frequency_select": random.choice(frequencies)}),
+                ("trend: date range", {
+                    "trend_analysis-input_date_range:shiny.date": self.date_range(location)}),
+            ]))
+
+        actions.append(("tab: cross analysis", hidden(cross_outputs)))
+        for _ in range(self.steps):
+            actions.append(random.choice([
+                ("cross: variable", {
+                    "cross_analysis-cross_analysis_var_1": random.choice(["氣溫", "空氣相對溼度", "氣壓"]),
+                    "cross_analysis-cross_analysis_var_2": random.choice(["氣溫", "空氣相對溼度", "光強度"])}),
+                ("cross: frequency", {
+                    "cross_analysis-frequency_select_alt": random.choice(frequencies)}),
+                ("cross: date range", {
+                    "cross_analysis-input_date_range_alt:shiny.date": self.date_range("indoor")}),
+                ("cross: splom", {
+                    "cross_analysis-splom_variables": self.splom_variables()}),
+            ]))
+
+        actions.append(("tab: dataframe", hidden(dataframe_outputs[:1])))
+        actions.append(("dataframe: outdoor", hidden(dataframe_outputs[1:2])))
+        actions.append(("dataframe: statistics", hidden(dataframe_outputs[2:])))
+        actions.append(("statistics: date range", {
+            "dataframe-stats_mode": random.choice(["summary", "daily"]),
+            "dataframe-stats_date_range:shiny.date": self.date_range("indoor")}))
+        return actions
+
+    async def wait_quiet(self, ws, start: float) -> float:
+        """
+        等到 settle 秒內沒有新的輸出，回傳最後一個輸出距離 start 的秒數
+
+        debounce 讓一次操作分成數次 flush，所以不能只看第一次 idle。
+        """
+        last = None
+        while True:
+            try:
+                message = await asyncio.wait_for(ws.recv(), self.settle)
+            except asyncio.TimeoutError:
+                break
+            message = json.loads(message)
+            if message.get("errors"):
+                self.errors += list(message["errors"].values())
+            # 每次 flush 都會送出 values 等欄位，只計算有內容的訊息
+            if any(message.get(i) for i in ["values", "errors", "custom", "inputMessages"]):
+                last = time.perf_counter()
+        return None if last is None else last - start
+
+    async def run(self, done: asyncio.Event):
+        try:
+            async with websockets.connect(self.ws_url, max_size=None) as ws:
+                start = time.perf_counter()
+                await ws.send(json.dumps({"method": "init", "data": self.initial_inputs()}))
+                self.first_render = await self.wait_quiet(ws, start)
+
+                for name, data in self.scenario():
+                    await asyncio.sleep(random.expovariate(1 / self.think))
+                    start = time.perf_counter()
+                    await ws.send(json.dumps({"method": "update", "data": data}))
+                    latency = await self.wait_quiet(ws, start)
+                    if latency is not None:
+                        self.interactions.append((name, latency))
+
+                # 保持連線，直到所有 session 都完成，才能量到同時在線時的記憶體
+                self.finished.set()
+                await done.wait()
+        except (OSError, websockets.WebSocketException) as e:
+            self.errors.append(repr(e))
+        finally:
+            self.finished.set()
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "n/a"
+    p = np.percentile(values, [50, 90, 95, 99]) * 1000
+    return "p50 {:6.0f}  p90 {:6.0f}  p95 {:6.0f}  p99 {:6.0f}  max {:6.0f} ms  (n={})".format(
+        *p, max(values) * 1000, len(values))
+
+
+async def simulate(args, index: dict) -> dict:
+    sessions = [
+        SimulatedSession(args.url, index, args.steps, args.think, args.settle)
+        for _ in range(args.sessions)
+    ]
+    done = asyncio.Event()
+
+    rss = dict()
+    if args.pid:
+        rss["baseline"] = read_rss(args.pid)
+
+    tasks = list()
+    for session in sessions:
+        tasks.append(asyncio.create_task(session.run(done)))
+        await asyncio.sleep(args.ramp)
+
+    # 所有 session 都完成操作後量測記憶體，再一起關閉
+    await asyncio.gather(*(session.finished.wait() for session in sessions))
+    if args.pid:
+        rss["connected"] = read_rss(args.pid)
+    accounted = await asyncio.to_thread(fetch_json, f"{args.url}/api/memory")
+    done.set()
+    await asyncio.gather(*tasks)
+    if args.pid:
+        await asyncio.sleep(args.settle)
+        rss["closed"] = read_rss(args.pid)
+    return {"sessions": sessions, "rss": rss, "accounted": accounted}
+
+
+def report(args, result: dict) -> dict:
+    sessions = result["sessions"]
+    first = [i.first_render for i in sessions if i.first_render is not None]
+    interactions = dict()
+    for session in sessions:
+        for name, latency in session.interactions:
+            interactions.setdefault(name, list()).append(latency)
+    errors = [e for session in sessions for e in session.errors]
+
+    print(f"sessions: {len(sessions)}, errors: {len(errors)}")
+    print(f"{'first render':<26}{percentiles(first)}")
+    print(f"{'all interactions':<26}{percentiles([j for i in interactions.values() for j in i])}")
+    for name, values in sorted(interactions.items()):
+        print(f"  {name:<24}{percentiles(values)}")
+    for e in sorted(set(map(str, errors)))[:10]:
+        print("  error:", e[:200])
+
+    summary = {
+        "sessions": len(sessions),
+        "errors": len(errors),
+        "first_render": first,
+        "interactions": interactions,
+    }
+    rss = result["rss"]
+    if rss:
+        mb = 1024 ** 2
+        per_session = (rss["connected"] - rss["baseline"]) / len(sessions)
+        print(f"server rss: baseline {rss['baseline'] / mb:.0f} MB, "
+              f"{len(sessions)} sessions {rss['connected'] / mb:.0f} MB, "
+              f"after close {rss['closed'] / mb:.0f} MB, "
+              f"{per_session / mb:.1f} MB per session")
+        summary["rss"] = rss
+        summary["rss_per_session"] = per_session
+
+    # 儀表板自己統計的各 session 用量（/api/memory）
+    accounted = result["accounted"]
+    kinds = dict()
+    for session in accounted["sessions"]:
+        for name, size in session["bytes"].items():
+            kinds[name] = kinds.get(name, 0) + size
+    print(f"accounted: {accounted['total'] / 1024 ** 2:.1f} MB in "
+          f"{len(accounted['sessions'])} sessions "
+          f"({', '.join(f'{k} {v / 1024 ** 2:.1f} MB' for k, v in sorted(kinds.items()))})")
+    summary["accounted"] = accounted
+    return summary
+
+
+def wait_for_server(url: str, timeout: float = 120):
+    end = time.time() + timeout
+    while True:
+        try:
+            return fetch_index(url)
+        except OSError:
+            if time.time() > end:
+                raise
+            time.sleep(.5)
+
+
+def run(args):
+    random.seed(args.seed)
+    server = None
+    if args.spawn:
+        port = urlparse(args.url).port or 8000
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app",
+             "--port", str(port), "--log-level", "warning"],
+            cwd=root_dir,
+        )
+        args.pid = server.pid
+
+    try:
+        index = wait_for_server(args.url)
+        result = asyncio.run(simulate(args, index))
+        summary = report(args, result)
+        if args.json:
+            Path(args.json).write_text(json.dumps(summary, indent=2))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_csv = subparsers.add_parser("csv-server", help="替代 Google 表格的本機 CSV 伺服器")
+    parser_csv.add_argument("--dir", default=str(root_dir / "loadtest"),
+                            help="存放 <位置>.csv 的目錄，不存在的檔案會自動產生")
+    parser_csv.add_argument("--port", type=int, default=8800)
+    parser_csv.add_argument("--days", type=int, default=60,
+                            help="產生的合成資料天數")
+    parser_csv.add_argument("--regenerate", action="store_true")
+    parser_csv.set_defaults(fn=csv_server)
+
+    parser_run = subparsers.add_parser("run", help="模擬多個 session")
+    parser_run.add_argument("--url", default="http://127.0.0.1:8000")
+    parser_run.add_argument("--sessions", type=int, default=10)
+    parser_run.add_argument("--ramp", type=float, default=.2,
+                            help="每個 session 開啟的間隔秒數")
+    parser_run.add_argument("--steps", type=int, default=5,
+                            help="每個分頁的操作次數")
+    parser_run.add_argument("--think", type=float, default=1,
+                            help="操作之間的平均等待秒數")
+    parser_run.add_argument("--settle", type=float, default=1.5,
+                            help="多久沒有新輸出視為繪製完成，需大於 debounce 的延遲")
+    parser_run.add_argument("--pid", type=int,
+                            help="儀表板的行程 id，用來量測記憶體")
+    parser_run.add_argument("--spawn", action="store_true",
+                            help="由本工具啟動儀表板")
+    parser_run.add_argument("--seed", type=int, default=0)
+    parser_run.add_argument("--json", help="將結果另存為 JSON，方便比較不同版本")
+    parser_run.set_defaults(fn=run)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
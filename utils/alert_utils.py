@@ -0,0 +1,334 @@
+import json
+import logging
+import threading
+import urllib.request
+from collections import deque
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from config import root_dir
+from utils.server_utils import as_float64
+
+# 門檻警示規則引擎
+#
+# 規則設定於 secrets.toml 的 [alerts]，例如：
+#
+# [alerts]
+# log_path = "alerts.log"
+# webhook = "http://127.0.0.1:9000/alerts"
+#
+# [[alerts.rules]]
+# name = "土壤濕度過低"
+# location = "outdoor"
+# duration = 30                       # 條件需持續的分鐘數，預設 0
+# conditions = [{ variable = "土壤濕度1", op = "<", value = 20 }]
+#
+# [[alerts.rules]]
+# name = "高電導度且高溫"
+# location = "indoor"
+# conditions = [
+#     { variable = "土壤電導度1", op = ">", value = 1500 },
+#     { variable = "氣溫", op = ">", value = 30 },
+# ]
+#
+# [[alerts.rules]]
+# name = "土壤濕度快速下降"
+# location = "outdoor"
+# conditions = [{ variable = "土壤濕度2", op = "<", value = -5, rate = true }]  # 每小時變化量
+#
+# 每條規則的所有條件同時成立才算成立；同一段連續成立的期間只會發出一次警示。
+#
+# 規則只在一個行程中評估，避免多個 worker 重複發出同一個警示：
+# 共享記憶體模式由 loader 行程評估，否則由取得檔案鎖的 worker 評估。
+# 發出的警示逐行寫入 history_path（預設 alerts.jsonl），各 worker 的警示頁面讀取這個檔案；
+# 重新啟動後第一次評估時也依這個檔案還原各規則的狀態，不會重複發出同一段期間的警示。
+
+default_history_path = root_dir / "alerts.jsonl"
+
+operators = {
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+logger = logging.getLogger("daxi_farm_sensor.alerts")
+
+
+class RuleState:
+    """
+    規則跨批次的狀態：目前連續成立的起點與是否已發出警示
+    """
+
+    def __init__(self):
+        self.active_since = None
+        self.fired = False
+
+
+class AlertEngine:
+    """
+    只對上次評估之後新增的資料列做向量化評估
+    """
+
+    def __init__(self, rules: list, lookback_hours: float = 24, sinks: list = None, maxlen: int = 500,
+                 history: "AlertFeed" = None):
+        self.rules = [dict(rule) for rule in rules]
+        self.lookback = pd.Timedelta(hours=lookback_hours)
+        self.sinks = sinks or list()
+        self.history = history
+        self.alerts = deque(maxlen=maxlen)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._last_row = dict()
+        self._states = dict()
+
+    def evaluate(self, location: str, sheet: pd.DataFrame) -> list:
+        """
+        評估 sheet 中尚未評估過的資料列，回傳新發出的警示
+
+        第一次評估只看最後 lookback_hours 小時，且從紀錄檔中最後一次警示之後開始，
+        避免重新啟動時對整段歷史或已發出的警示再次發出警示。
+        """
+        with self._lock:
+            previous = self._last_row.get(location)
+            if previous is None:
+                previous = self._seed(location, sheet)
+            new = sheet.loc[sheet['時間'] > previous['時間'].iloc[0]] \
+                if len(previous) else sheet
+            if new.empty:
+                return list()
+
+            fired = list()
+            for i, rule in enumerate(self.rules):
+                if rule.get("location", location) == location:
+                    state = self._states.setdefault((i, location), RuleState())
+                    fired += self._evaluate_rule(rule, state, location,
+                                                 previous, new)
+            self._last_row[location] = new.iloc[-1:]
+
+        fired.sort(key=lambda alert: alert["time"])
+        self.alerts.extend(fired)
+        self.count += len(fired)
+        for alert in fired:
+            for sink in self.sinks:
+                sink(alert)
+        return fired
+
+    def _seed(self, location: str, sheet: pd.DataFrame) -> pd.DataFrame:
+        """
+        依紀錄檔中已發出的警示還原該位置各規則的狀態，回傳評估起點的最後一列
+
+        曾發出警示的規則從警示那一列開始靜默評估到起點，
+        若條件一直成立到起點，同一段期間之後不會再次發出警示。
+        """
+        sent = dict()
+        if self.history is not None:
+            for alert in self.history.refresh().alerts:
+                if alert["location"] == location:
+                    sent[alert["rule"]] = alert["time"]
+
+        t = sheet['時間']
+        start = max([t.max() - self.lookback, *sent.values()])
+        for i, rule in enumerate(self.rules):
+            if rule.get("location", location) != location or rule["name"] not in sent:
+                continue
+            state = self._states.setdefault((i, location), RuleState())
+            state.active_since = sent[rule["name"]]
+            state.fired = True
+            warm = sheet.loc[(t > state.active_since) & (t <= start)]
+            if not warm.empty:
+                self._evaluate_rule(rule, state, location,
+                                    sheet.loc[t <= state.active_since].iloc[-1:], warm)
+        return sheet.loc[t <= start].iloc[-1:]
+
+    def _evaluate_rule(self, rule: dict, state: RuleState, location: str,
+                       previous: pd.DataFrame, new: pd.DataFrame) -> list:
+        df = pd.concat([previous, new]) if len(previous) else new
+        t = df['時間']
+        hours = t.diff().dt.total_seconds() / 3600
+
+        mask = pd.Series(True, index=df.index)
+        for condition in rule["conditions"]:
+            if condition["variable"] not in df.columns:
+                return list()
+            values = df[condition["variable"]]
+            if condition.get("rate", False):
+                values = values.diff() / hours
+            op = operators[condition["op"]]
+            mask &= op(values, condition["value"]).fillna(False)
+
+        # 去掉只用來計算變化量的前一列
+        mask = mask.iloc[len(previous):]
+        t = t.iloc[len(previous):]
+        df = df.iloc[len(previous):]
+
+        # 每段連續成立的期間編號；批次開頭的第 0 段延續上一批次的狀態
+        run = (~mask).cumsum()
+        start = t.where(mask).groupby(run).transform("min")
+        continuing = run == 0
+        if state.active_since is not None:
+            start = start.mask(continuing, state.active_since)
+
+        duration = pd.Timedelta(minutes=rule.get("duration", 0))
+        hit = mask & (t - start >= duration)
+        if state.fired:
+            hit &= ~continuing
+
+        first_hits = as_float64(df.loc[hit].groupby(run[hit]).head(1), rounded=True)
+
+        if mask.iloc[-1]:
+            last_run = run.iloc[-1]
+            state.fired = bool(hit[run == last_run].any()) or \
+                (state.fired and last_run == 0)
+            state.active_since = start.iloc[-1]
+        else:
+            state.fired = False
+            state.active_since = None
+
+        variables = [condition["variable"] for condition in rule["conditions"]]
+        return [
+            {
+                "time": row['時間'],
+                "location": location,
+                "rule": rule["name"],
+                "values": {i: float(row[i]) for i in variables},
+            }
+            for _, row in first_hits.iterrows()
+        ]
+
+
+def log_sink(path: str):
+    """
+    將警示寫入本機紀錄檔
+    """
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    def sink(alert: dict):
+        logger.info(json.dumps(alert, ensure_ascii=False, default=str))
+
+    return sink
+
+
+def webhook_sink(url: str, timeout: float = 5):
+    """
+    在背景執行緒以 POST 將警示送到 webhook，不阻塞儀表板
+    """
+    def post(alert: dict):
+        body = json.dumps(alert, ensure_ascii=False, default=str).encode()
+        request = urllib.request.Request(
+            url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(request, timeout=timeout).close()
+        except OSError as e:
+            logger.warning(f"webhook {url} failed: {e}")
+
+    def sink(alert: dict):
+        threading.Thread(target=post, args=(alert, ), daemon=True).start()
+
+    return sink
+
+
+def history_sink(path):
+    """
+    將警示逐行寫成 JSON，供所有 worker 的警示頁面讀取
+    """
+    lock = threading.Lock()
+
+    def sink(alert: dict):
+        line = json.dumps(alert, ensure_ascii=False, default=str)
+        with lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    return sink
+
+
+class AlertFeed:
+    """
+    讀取 history_sink 寫入的警示紀錄，檔案變大時只讀取新增的部分
+    """
+
+    def __init__(self, path, maxlen: int = 500):
+        self.path = Path(path)
+        self.alerts = deque(maxlen=maxlen)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._offset = 0
+
+    def refresh(self):
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+
+        with self._lock:
+            if size == self._offset:
+                return self
+            if size < self._offset:
+                # 紀錄檔被清除或輪替，從頭讀取
+                self.alerts.clear()
+                self.count = 0
+                self._offset = 0
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                chunk = f.read(size - self._offset)
+            # 只處理完整的行，寫到一半的行留到下次
+            chunk = chunk[:chunk.rfind(b"\n") + 1]
+            self._offset += len(chunk)
+            for line in chunk.decode("utf-8").splitlines():
+                alert = json.loads(line)
+                alert["time"] = pd.Timestamp(alert["time"])
+                self.alerts.append(alert)
+                self.count += 1
+        return self
+
+
+class EvaluatorLock:
+    """
+    多個 worker 中只有取得檔案鎖的行程評估規則
+
+    持有鎖的行程結束時鎖會自動釋放，由下一個更新表格的 worker 接手。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # 沒有檔案鎖的平台（Windows）只支援單一行程
+            return True
+
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+
+def create_engine(alert_config: dict) -> AlertEngine:
+    """
+    依設定建立規則引擎與輸出
+    """
+    history_path = alert_config.get("history_path", default_history_path)
+    sinks = [history_sink(history_path)]
+    if alert_config.get("log_path"):
+        sinks.append(log_sink(alert_config["log_path"]))
+    if alert_config.get("webhook"):
+        sinks.append(webhook_sink(alert_config["webhook"]))
+
+    return AlertEngine(
+        rules=alert_config.get("rules", []),
+        lookback_hours=alert_config.get("lookback_hours", 24),
+        sinks=sinks,
+        history=AlertFeed(history_path),
+    )
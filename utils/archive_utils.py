@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+import threading
+from datetime import date
+from pathlib import Path
+import pandas as pd
+
+# 依位置與月份分割的本機封存
+#
+# Google 表格有儲存格上限，舊資料會被移出表格；每次讀取表格時把新的資料列附加到
+# archive/<位置>/<YYYY-MM>.parquet，查詢時只開啟與日期區間重疊的月份。
+# 沒有安裝 pyarrow 時改用 pickle。
+
+try:
+    import pyarrow  # noqa: F401
+    partition_suffix = ".parquet"
+except ImportError:
+    partition_suffix = ".pkl"
+
+
+def write_partition(df: pd.DataFrame, path: Path):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    if partition_suffix == ".parquet":
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, path)
+
+
+def read_partition(path: Path, columns: list = None) -> pd.DataFrame:
+    if partition_suffix == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+    df = pd.read_pickle(path)
+    return df if columns is None else df[columns]
+
+
+class SheetArchive:
+    """
+    月份分割的封存
+
+    每個位置有一個 manifest.json，記錄每個月份分割的起訖時間與列數，
+    查詢時不需開啟檔案即可決定要讀取哪些分割。
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def _manifest_path(self, location: str) -> Path:
+        return self.root / location / "manifest.json"
+
+    def manifest(self, location: str) -> dict:
+        path = self._manifest_path(location)
+        if not path.exists():
+            return dict()
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def _partition_path(self, location: str, month: str) -> Path:
+        return self.root / location / (month + partition_suffix)
+
+    def append(self, location: str, sheet: pd.DataFrame):
+        """
+        把 sheet 中比封存新的資料列附加到對應的月份分割
+
+        只會改寫有新資料的月份。
+        """
+        with self._lock:
+            (self.root / location).mkdir(parents=True, exist_ok=True)
+            manifest = self.manifest(location)
+
+            months = sheet['時間'].dt.strftime("%Y-%m")
+            for month, rows in sheet.groupby(months, sort=True):
+                info = manifest.get(month)
+                if info is not None:
+                    rows = rows.loc[rows['時間'] > pd.Timestamp(info["end"])]
+                    if rows.empty:
+                        continue
+                    existing = read_partition(
+                        self._partition_path(location, month))
+                    rows = pd.concat([existing, rows], ignore_index=True)
+
+                rows = rows.sort_values('時間').reset_index(drop=True)
+                write_partition(rows, self._partition_path(location, month))
+                manifest[month] = {
+                    "start": rows['時間'].iloc[0].isoformat(),
+                    "end": rows['時間'].iloc[-1].isoformat(),
+                    "rows": len(rows),
+                }
+
+            path = self._manifest_path(location)
+            tmp = path.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+            os.replace(tmp, path)
+
+    def date_range(self, location: str):
+        """
+        封存的日期區間；尚未封存時回傳 None
+        """
+        manifest = self.manifest(location)
+        if not manifest:
+            return None
+        start = min(pd.Timestamp(i["start"]) for i in manifest.values())
+        end = max(pd.Timestamp(i["end"]) for i in manifest.values())
+        return start.date(), end.date()
+
+    def query(self, location: str, m: date, M: date, columns: list = None) -> pd.DataFrame:
+        """
+        讀取 m 到 M（包含）之間的資料列，只開啟與區間重疊的月份分割
+        """
+        start = pd.Timestamp(m)
+        end = pd.Timestamp(M) + pd.Timedelta(days=1)
+        if columns is not None:
+            columns = ['時間'] + [i for i in columns if i != '時間']
+
+        frames = list()
+        for month, info in sorted(self.manifest(location).items()):
+            if pd.Timestamp(info["end"]) < start or pd.Timestamp(info["start"]) >= end:
+                continue
+            df = read_partition(self._partition_path(location, month), columns)
+            frames.append(df.loc[(df['時間'] >= start) & (df['時間'] < end)])
+
+        if not frames:
+            return pd.DataFrame(columns=columns or ['時間'])
+        return pd.concat(frames, ignore_index=True)
+
+
+class BatchedArchiveWriter:
+    """
+    合併短時間內的多次更新，最多每 delay 秒寫入封存一次
+
+    submit() 只記下最新的表格，真正的寫入在背景計時器觸發時進行。
+    """
+
+    def __init__(self, archive: SheetArchive, delay: float = 30):
+        self.archive = archive
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def submit(self, sheets: dict):
+        with self._lock:
+            self._pending.update(sheets)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for location, sheet in pending.items():
+            self.archive.append(location, sheet)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from config import derived_config
+
+# 由量測值推導的農業變數（虛擬欄位）
+#
+# 只在第一次被選取時計算，結果依表格版本快取於 SheetStore。
+
+# 蘆筍生長度日的基礎溫度（°C）
+asparagus_base_temperature = 5
+
+# 生長度日每年自這一天（月-日）起重新累積，於 secrets.toml 設定，例如：
+#
+# [derived]
+# season_start = "03-01"
+season_month, season_day = map(int, derived_config.get("season_start", "01-01").split("-"))
+
+
+def saturation_vapour_pressure(temperature: pd.Series) -> pd.Series:
+    """
+    飽和水氣壓（kPa），Tetens 公式
+    """
+    return 0.6108 * np.exp(17.27 * temperature / (temperature + 237.3))
+
+
+def vapour_pressure_deficit(sheet: pd.DataFrame) -> pd.Series:
+    """
+    飽和水氣壓差（kPa）
+    """
+    es = saturation_vapour_pressure(sheet['氣溫'])
+    return es * (1 - sheet['空氣相對溼度'] / 100)
+
+
+def dew_point(sheet: pd.DataFrame) -> pd.Series:
+    """
+    露點溫度（°C），Magnus 公式
+    """
+    b, c = 17.62, 243.12
+    t = sheet['氣溫']
+    rh = sheet['空氣相對溼度'].where(sheet['空氣相對溼度'] > 0)
+    gamma = np.log(rh / 100) + b * t / (c + t)
+    return c * gamma / (b - gamma)
+
+
+def season_start(t) -> pd.Timestamp:
+    """
+    t 所在季節的起始日
+    """
+    t = pd.Timestamp(t)
+    start = pd.Timestamp(t.year, season_month, season_day)
+    return start if start <= t else pd.Timestamp(t.year - 1, season_month, season_day)
+
+
+def growing_degree_days(sheet: pd.DataFrame) -> pd.Series:
+    """
+    蘆筍累積生長度日（°C·日），自該列所在季節的起始日累積到該列所在的日期
+
+    sheet 需包含季節起始日以來的資料，SheetStore 會以封存補上較早的資料列。
+    """
+    daily = sheet.resample('D', on='時間')['氣溫'].agg(["min", "max"])
+    increments = ((daily["min"] + daily["max"]) / 2 - asparagus_base_temperature) \
+        .clip(lower=0).fillna(0)
+    days = daily.index
+    before_start = (days.month < season_month) | \
+        ((days.month == season_month) & (days.day < season_day))
+    gdd = increments.groupby(days.year - before_start).cumsum()
+    return pd.Series(gdd.reindex(sheet['時間'].dt.normalize()).to_numpy(), index=sheet.index)
+
+
+def wind_speed(sheet: pd.DataFrame) -> pd.Series:
+    """
+    風速（m/s）：感測器回傳伏特，乘以 6 換算
+    """
+    return sheet['風速'] * 6
+
+
+# 變數名稱: (需要的欄位, 計算函式)
+derived_variables = {
+    "飽和水氣壓差": (['氣溫', '空氣相對溼度'], vapour_pressure_deficit),
+    "露點溫度": (['氣溫', '空氣相對溼度'], dew_point),
+    "生長度日": (['氣溫'], growing_degree_days),
+    "風速（m/s）": (['風速'], wind_speed),
+}
+
+
+# 需要自季節起始日以來的資料才能計算的虛擬變數
+seasonal_variables = ["生長度日"]
+
+
+def get_derived_variables(sheet: pd.DataFrame) -> list:
+    """
+    取得資料框可以推導的虛擬變數名稱
+    """
+    return [
+        name for name, (required, _) in derived_variables.items()
+        if all(i in sheet.columns for i in required)
+    ]
+
+
+def compute_derived(sheet: pd.DataFrame, name: str) -> pd.Series:
+    """
+    計算虛擬變數，回傳與 sheet 同索引的欄位；輸入欄位先轉成 float64 再計算
+    """
+    required, fn = derived_variables[name]
+    sheet = sheet[['時間'] + required].astype({i: "float64" for i in required})
+    return fn(sheet).rename(name)
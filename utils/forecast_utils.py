@@ -0,0 +1,184 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# 土壤濕度預測
+#
+# 以每小時資料的滯後線性迴歸，直接預測每個土壤濕度感測器未來 1 到 horizon 小時的變化量。
+# 每個感測器各自有一組模型：特徵 X 為該感測器的滯後值加上共用的氣象、雨量與時刻特徵，
+# 目標 Y 的每一欄是一個預測時數。同一位置的 P 個感測器疊成 (P, n, k) 的設計矩陣，
+# 以各自的缺失遮罩一次用 einsum 累加 (P, k, k) 的 XᵀX 與 (P, k, horizon) 的 XᵀY，
+# 再以一次批次的 np.linalg.solve 解出所有感測器的 (XᵀX + λI)β = XᵀY。
+# 某個感測器故障（整段缺失）時只影響它自己，其他感測器照常預測。
+# 表格更新時只把新增、且已經有完整目標值的小時加進 XᵀX、XᵀY，再重新求解。
+
+# 土壤濕度的滯後時數
+moisture_lags = [0, 1, 3, 6, 12, 24]
+
+# 作為輸入的氣象變數（取當下的值）
+weather_columns = ['氣溫', '空氣相對溼度', '光強度']
+
+# 雨量強度的累計時數
+rain_windows = [1, 6, 24]
+
+# 感測器最後一筆完整特徵早於表格最後一小時超過此時間時不預測
+stale_after = pd.Timedelta(hours=24)
+
+
+def moisture_columns(hourly: pd.DataFrame) -> list:
+    return [i for i in hourly.columns if str(i).startswith("土壤濕度")]
+
+
+def forecast_features(hourly: pd.DataFrame, column: str) -> pd.DataFrame:
+    """
+    由每小時資料建立 column 的特徵，每一列只使用該小時（含）以前的資料
+    """
+    features = {"截距": np.ones(len(hourly))}
+    for lag in moisture_lags:
+        features[f"{column}_{lag}"] = hourly[column].shift(lag)
+    for weather in weather_columns:
+        if weather in hourly.columns:
+            features[weather] = hourly[weather]
+    if 'rain_IPH' in hourly.columns:
+        intensity = hourly['rain_IPH'].fillna(0)
+        for window in rain_windows:
+            features[f"雨量強度_{window}"] = intensity.rolling(window, min_periods=1).sum()
+
+    hour = hourly['時間'].dt.hour.to_numpy()
+    features["時_sin"] = np.sin(hour / 24 * 2 * np.pi)
+    features["時_cos"] = np.cos(hour / 24 * 2 * np.pi)
+    return pd.DataFrame(features, index=hourly.index)
+
+
+def forecast_targets(hourly: pd.DataFrame, column: str, horizon: int) -> pd.DataFrame:
+    """
+    column 未來 1 到 horizon 小時相對於當下的變化量
+    """
+    targets = {h: hourly[column].shift(-h) - hourly[column]
+               for h in range(1, horizon + 1)}
+    return pd.DataFrame(targets, index=hourly.index)
+
+
+def stacked_features(hourly: pd.DataFrame, columns: list) -> tuple:
+    """
+    把各感測器的特徵疊成 (P, n, k) 陣列，回傳 (各感測器的特徵名稱, 陣列)
+    """
+    frames = [forecast_features(hourly, column) for column in columns]
+    if not frames:
+        return list(), np.empty((0, len(hourly), 0))
+    return [i.columns.tolist() for i in frames], \
+        np.stack([i.to_numpy(dtype="float64") for i in frames])
+
+
+class SoilMoistureForecaster:
+    """
+    各位置、各感測器的土壤濕度預測模型，累積 XᵀX、XᵀY 做增量擬合
+    """
+
+    def __init__(self, horizon: int = 48, ridge: float = 1e-3):
+        self.horizon = horizon
+        self.ridge = ridge
+        self._lock = threading.Lock()
+        self._state = dict()
+
+    def update(self, location: str, hourly: pd.DataFrame) -> dict:
+        """
+        把尚未使用、且目標值已完整的小時加進各感測器的 XᵀX 與 XᵀY，回傳該位置的模型狀態
+
+        hourly 的時間需連續（resample 的結果）；感測器或特徵改變時該位置從頭擬合。
+        """
+        hourly = hourly.reset_index(drop=True)
+        columns = moisture_columns(hourly)
+        return self._update(location, hourly, columns,
+                            *stacked_features(hourly, columns))
+
+    def _update(self, location: str, hourly: pd.DataFrame, columns: list,
+                features: list, X: np.ndarray) -> dict:
+        with self._lock:
+            state = self._state.get(location)
+            if state is None or state["columns"] != columns or state["features"] != features:
+                P, k = X.shape[0], X.shape[2]
+                state = {
+                    "columns": columns,
+                    "features": features,
+                    "XtX": np.zeros((P, k, k)),
+                    "XtY": np.zeros((P, k, self.horizon)),
+                    "n": np.zeros(P, dtype="int64"),
+                    "last": np.full(P, pd.Timestamp.min.to_datetime64()),
+                    "coef": np.full((P, k, self.horizon), np.nan),
+                }
+                self._state[location] = state
+            if not columns:
+                return state
+
+            # 只取任一感測器還沒用過、且目標值已完整的小時；最後 horizon 小時留到下次更新
+            t = hourly['時間'].to_numpy()
+            end = max(len(t) - self.horizon, 0)
+            begin = int(np.searchsorted(t, state["last"].min(), side="right"))
+            if begin >= end:
+                return state
+
+            x = X[:, begin:end]
+            y = np.stack([
+                forecast_targets(hourly, column, self.horizon).to_numpy(dtype="float64")[begin:end]
+                for column in columns])
+            rows = (t[begin:end] > state["last"][:, None]) & \
+                ~np.isnan(x).any(axis=2) & ~np.isnan(y).any(axis=2)
+            if not rows.any():
+                return state
+
+            # 各感測器缺失或已使用的列以 0 代入，不影響累加
+            x = np.where(rows[..., None], x, 0)
+            y = np.where(rows[..., None], y, 0)
+            state["XtX"] += np.einsum("pnk,pnj->pkj", x, x)
+            state["XtY"] += np.einsum("pnk,pnh->pkh", x, y)
+            state["n"] += rows.sum(axis=1)
+            used = rows.any(axis=1)
+            state["last"][used] = np.where(rows, t[begin:end], t[begin])[used].max(axis=1)
+
+            fitted = state["n"] > 0
+            penalty = self.ridge * np.eye(X.shape[2])
+            penalty[0, 0] = 0
+            state["coef"][fitted] = np.linalg.solve(
+                state["XtX"][fitted] + penalty * state["n"][fitted, None, None],
+                state["XtY"][fitted])
+            return state
+
+    def forecast(self, location: str, hourly: pd.DataFrame) -> pd.DataFrame:
+        """
+        每個感測器從它最後一個特徵完整的小時起，預測未來 horizon 小時的土壤濕度
+
+        每個感測器的第一個值是預測起點的實際值，方便在圖上與觀測值相接。
+        模型尚未擬合或最近沒有資料的感測器該欄為缺失值；全部都無法預測時回傳空表。
+        """
+        hourly = hourly.reset_index(drop=True)
+        columns = moisture_columns(hourly)
+        features, X = stacked_features(hourly, columns)
+        state = self._update(location, hourly, columns, features, X)
+        latest = hourly['時間'].max()
+
+        curves = dict()
+        for p, column in enumerate(columns):
+            if state["n"][p] == 0:
+                continue
+            complete = np.flatnonzero(~np.isnan(X[p]).any(axis=1))
+            if not len(complete):
+                continue
+            origin = complete[-1]
+            start = hourly.loc[origin, '時間']
+            if latest - start > stale_after:
+                continue
+
+            current = float(hourly.loc[origin, column])
+            delta = X[p, origin] @ state["coef"][p]
+            curves[column] = pd.Series(
+                np.concatenate([[current], current + delta]),
+                index=pd.date_range(start, periods=self.horizon + 1, freq="H"),
+            )
+
+        if not curves:
+            return pd.DataFrame(columns=['時間'] + columns)
+
+        df = pd.DataFrame(curves).reindex(columns=columns)
+        df.index.name = '時間'
+        return df.reset_index()
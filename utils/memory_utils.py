@@ -0,0 +1,248 @@
+import threading
+import time
+import numpy as np
+import pandas as pd
+from shiny import reactive
+from shiny.session import Session, session_context
+from config import memory_config
+from utils.sheet_store import store
+
+# 每個 session 的記憶體用量統計與回收
+#
+# session 自己持有的資料分成三類：
+# - 共用表格（indoor_sheet、outdoor_sheet）：與 store 是同一個物件時不計入，
+#   只有還留著舊版本表格時才算這個 session 的用量
+# - 衍生資料（user_sheet、依輸入切出的資料框）：閒置超過 idle_minutes 或
+#   所有 session 的總用量超過 budget_mb 時丟棄，下次需要時再從 store 重新計算
+# - 圖表 widget：重新繪製時關閉舊的 widget，session 結束時全部關閉
+#
+# 設定於 secrets.toml 的 [memory]，例如：
+#
+# [memory]
+# budget_mb = 512
+# idle_minutes = 15
+# check_seconds = 60
+
+
+def nbytes(obj) -> int:
+    """
+    估計物件佔用的位元組數，只計算資料框、陣列與圖表的資料
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(obj, pd.DataFrame) else usage)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "data") and isinstance(getattr(obj, "data"), tuple):
+        # plotly 圖表：加總每個 trace 的 x、y，散佈矩陣加總每個維度的 values
+        return sum(
+            nbytes(value) if isinstance(value, np.ndarray) else len(value) * 8
+            for trace in obj.data
+            for value in trace_values(trace)
+            if value is not None
+        )
+    return 0
+
+
+def trace_values(trace) -> list:
+    """
+    trace 中的資料陣列；沒有 x、y 的 trace（例如 Splom）改取 dimensions 的 values
+    """
+    if trace.type == "splom":
+        return [dimension["values"] for dimension in trace.dimensions or ()]
+    return [trace[i] for i in ("x", "y") if i in trace]
+
+
+class SessionMemory:
+    """
+    一個 session 持有的資料
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.id = session.id
+        self.last_active = time.monotonic()
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._frames = dict()
+        self._values = dict()
+        self._shared = dict()
+        self._widgets = dict()
+
+    def touch(self):
+        """
+        記錄使用者的操作，閒置時間從最後一次操作起算
+        """
+        self.last_active = time.monotonic()
+
+    def cached(self, name: str, key, fn):
+        """
+        取得 name 的衍生資料；key 改變或已被回收時呼叫 fn 重新計算
+
+        不放在 reactive calc 中快取，才能在不觸發重新計算的情況下丟棄。
+        """
+        with self._lock:
+            entry = self._frames.get(name)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+
+        value = fn()
+        with self._lock:
+            self._frames[name] = (key, value, nbytes(value))
+        memory.enforce()
+        return value
+
+    def track(self, name: str, value: reactive.Value, shared: bool = False):
+        """
+        統計 reactive value 的用量；shared 為 True 時不會被回收
+        """
+        (self._shared if shared else self._values)[name] = value
+        return value
+
+    def widget(self, name: str, widget):
+        """
+        登記 name 目前的圖表 widget，並關閉被取代的舊 widget
+        """
+        old = self._widgets.get(name)
+        self._widgets[name] = widget
+        if old is not None and old is not widget:
+            old.close()
+        return widget
+
+    def usage(self) -> dict:
+        """
+        各項資料的位元組數；同一個物件只計算一次
+        """
+        usage = dict()
+        seen = set()
+        with self._lock:
+            for name, (_, value, size) in self._frames.items():
+                usage[name] = size
+                seen.add(id(value))
+        with reactive.isolate():
+            for name, value in self._values.items():
+                if value.is_set() and id(value.get()) not in seen:
+                    usage[name] = nbytes(value.get())
+            for name, value in self._shared.items():
+                if value.is_set() and all(
+                        value.get() is not store.get(i) for i in store.locations):
+                    usage[name] = nbytes(value.get())
+        for name, widget in self._widgets.items():
+            usage[name] = nbytes(widget)
+        return usage
+
+    def evictable_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, _, size in self._frames.values())
+
+    def evict(self):
+        """
+        丟棄衍生資料，下次使用時重新計算
+        """
+        with self._lock:
+            self._frames.clear()
+        with reactive.isolate():
+            for value in self._values.values():
+                if value.is_set():
+                    value.unset()
+        self.evictions += 1
+
+    def close(self):
+        """
+        session 結束：丟棄所有資料並關閉 widget
+        """
+        with self._lock:
+            self._frames.clear()
+        self._values.clear()
+        self._shared.clear()
+        with session_context(self.session):
+            for widget in self._widgets.values():
+                widget.close()
+        self._widgets.clear()
+
+
+class MemoryManager:
+    """
+    所有 session 的記憶體用量，依閒置時間與總預算回收衍生資料
+    """
+
+    def __init__(self, budget_mb: float = 512, idle_minutes: float = 15):
+        self.budget = budget_mb * 1024 ** 2
+        self.idle = idle_minutes * 60
+        self._lock = threading.Lock()
+        self._sessions = dict()
+
+    def register(self, session: Session) -> SessionMemory:
+        memory = SessionMemory(session)
+        with self._lock:
+            self._sessions[memory.id] = memory
+
+        def unregister():
+            with self._lock:
+                self._sessions.pop(memory.id, None)
+            memory.close()
+
+        session.on_ended(unregister)
+        return memory
+
+    def sessions(self) -> list:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def enforce(self):
+        """
+        回收閒置的 session；總用量超過預算時，從最久沒有操作的 session 開始回收
+        """
+        now = time.monotonic()
+        sessions = sorted(self.sessions(), key=lambda i: i.last_active)
+        sizes = {i.id: i.evictable_bytes() for i in sessions}
+        total = sum(sizes.values())
+
+        for session in sessions:
+            if sizes[session.id] == 0:
+                continue
+            if now - session.last_active > self.idle or total > self.budget:
+                session.evict()
+                total -= sizes[session.id]
+
+    def report(self) -> dict:
+        """
+        各 session 的用量；不包含 session id，避免洩漏下載等路徑
+        """
+        now = time.monotonic()
+        sessions = [
+            {
+                "idle_seconds": round(now - session.last_active),
+                "evictions": session.evictions,
+                "bytes": session.usage(),
+            }
+            for session in self.sessions()
+        ]
+        return {
+            "budget": self.budget,
+            "idle_seconds": self.idle,
+            "total": sum(sum(i["bytes"].values()) for i in sessions),
+            "sessions": sessions,
+        }
+
+
+memory = MemoryManager(
+    budget_mb=memory_config.get("budget_mb", 512),
+    idle_minutes=memory_config.get("idle_minutes", 15),
+)
+
+check_seconds = memory_config.get("check_seconds", 60)
+
+
+def session_memory(session: Session) -> SessionMemory:
+    """
+    在 server 函式中呼叫，登記 session 並定期檢查閒置與預算
+    """
+    tracker = memory.register(session)
+
+    @reactive.Effect
+    def _():
+        reactive.invalidate_later(check_seconds)
+        memory.enforce()
+
+    return tracker
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from plotly import graph_objects as go
+from plotly.colors import qualitative
+from plotly.subplots import make_subplots
+
+# 感測器精度（見 introduction.md 的「變數單位與感測器精度」）
+sensor_precision = {
+    "氣壓": .06,
+    "氣溫": .5,
+    "空氣相對溼度": 2,
+    "光強度": 1,
+    "風速": .1 / 6,
+    "土壤溫度": .5,
+    "土壤濕度": 3,
+    "土壤電導度": 10,
+}
+
+
+def get_precision(column: str):
+    """
+    取得變數的感測器精度，未知時回傳 None
+    """
+    for prefix, precision in sensor_precision.items():
+        if str(column).startswith(prefix):
+            return precision
+    return None
+
+
+def compact_values(series: pd.Series) -> np.ndarray:
+    """
+    將數值欄位轉成傳送給瀏覽器的 typed array
+
+    float32 的捨入誤差遠小於感測器精度時以 float32 傳送，其餘維持 float64；
+    plotly 的 FigureWidget 會把一維數值 numpy 陣列以二進位 buffer 傳送，而非 JSON 串列。
+    """
+    values = series.to_numpy(dtype="float64", na_value=np.nan)
+    precision = get_precision(series.name)
+    if precision is None or len(values) == 0:
+        return values
+
+    magnitude = np.nanmax(np.abs(values), initial=0)
+    if magnitude * np.finfo("float32").eps < precision / 10:
+        return values.astype("float32")
+    return values
+
+
+def compact_time(series: pd.Series) -> np.ndarray:
+    """
+    將時間欄位轉成 epoch 毫秒（float64 typed array）
+
+    plotly 的日期軸接受 epoch 毫秒，需搭配 xaxis type="date"；
+    JavaScript 沒有 int64 的 typed array，因此以 float64 傳送（毫秒精度不受影響）。
+    """
+    return series.to_numpy(dtype="datetime64[ms]").astype("int64").astype("float64")
+
+
+def stratified_sample(df: pd.DataFrame, budget: int, time: pd.Series, seed: int = 0) -> pd.DataFrame:
+    """
+    依日期分層隨機抽樣，最多保留約 budget 列
+
+    每一天依資料列數按比例分配名額，抽樣後仍涵蓋整段區間；天數多於 budget 時改以月份分層。
+    固定亂數種子，同樣的輸入得到同樣的樣本。
+    """
+    if len(df) <= budget:
+        return df
+
+    strata = time.dt.floor("D")
+    if strata.nunique() > budget:
+        strata = time.dt.to_period("M")
+    strata = strata.to_numpy()
+
+    rng = np.random.default_rng(seed)
+    rank = pd.Series(rng.random(len(df))).groupby(strata).rank(method="first")
+    size = pd.Series(strata).groupby(strata).transform("size")
+    quota = np.maximum(1, np.round(size * budget / len(df)))
+    return df.loc[(rank <= quota).to_numpy()]
+
+
+def sync_traces(fig, x: np.ndarray, columns: dict, refresh: bool, make_trace, keep=None):
+    """
+    以最少的 trace 操作讓 FigureWidget 顯示 columns 中的變數
+
+    只移除未選取的 trace、新增新選取的 trace；refresh 為 True 時（例如區間或頻率改變）
+    才更新既有 trace 的資料。所有變更在同一個 batch_update 中送出。
+    keep(trace) 為 True 的 trace 由其他地方管理，不會被移除或更新。
+    """
+    def managed(trace):
+        return keep is None or not keep(trace)
+
+    with fig.batch_update():
+        kept = tuple(t for t in fig.data if t.name in columns or not managed(t))
+        if len(kept) != len(fig.data):
+            fig.data = kept
+
+        existing = [t.name for t in fig.data if managed(t)]
+        if refresh:
+            for trace in fig.data:
+                if managed(trace):
+                    trace.x = x
+                    trace.y = columns[trace.name]
+
+        for name, y in columns.items():
+            if name not in existing:
+                fig.add_trace(make_trace(x=x, y=y, name=name))
+
+
+soil_measurements = ["土壤溫度", "土壤濕度", "土壤電導度"]
+
+
+def soil_sensor_figure(df: pd.DataFrame, make_trace) -> go.Figure:
+    """
+    土壤感測器分面圖
+
+    溫度、濕度、電導度各一列共用 x 軸，每個感測器一條線；
+    同一個感測器的三條線使用同一個圖例群組，點選圖例即可同時切換。
+    """
+    fig = make_subplots(
+        rows=len(soil_measurements),
+        cols=1,
+        shared_xaxes=True,
+        vertical_spacing=.04,
+        subplot_titles=soil_measurements,
+    )
+    x = compact_time(df['時間'])
+    colors = qualitative.Plotly
+
+    for column in df.columns:
+        for row, measurement in enumerate(soil_measurements, start=1):
+            if not column.startswith(measurement):
+                continue
+            num = column[len(measurement):]
+            fig.add_trace(
+                make_trace(
+                    x=x,
+                    y=compact_values(df[column]),
+                    name="土壤感測器" + num,
+                    legendgroup=num,
+                    showlegend=row == 1,
+                    line_color=colors[(int(num) - 1) % len(colors)],
+                ),
+                row=row,
+                col=1,
+            )
+
+    fig.update_xaxes(type="date")
+    fig.update_layout(
+        autosize=True,
+        height=600,
+        margin={
+            "t": 20,
+            "b": 0
+        },
+    )
+    return fig
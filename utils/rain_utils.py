@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+# 降雨事件切割
+#
+# 室外雨量計回報：雨量、rain_event（本次事件累積雨量）、rain_totalevent（累積總雨量）
+# 與 rain_IPH（雨量強度，mm/h）。每次讀取表格後以一次向量化的處理切出事件表，
+# 趨勢圖以事件表標示降雨期間，土壤濕度反應圖只切取每個事件前後的資料列。
+
+rain_columns = ['雨量', 'rain_event', 'rain_totalevent', 'rain_IPH']
+
+# 兩段降雨間隔超過此時間才視為不同事件
+event_gap = pd.Timedelta(hours=1)
+
+event_columns = ['開始', '結束', '時數', '總雨量', '最大雨量強度']
+
+
+def has_rain(sheet: pd.DataFrame) -> bool:
+    return all(i in sheet.columns for i in rain_columns)
+
+
+def rain_events(sheet: pd.DataFrame, gap: pd.Timedelta = event_gap) -> pd.DataFrame:
+    """
+    切出降雨事件，回傳以開始時間為索引的事件表
+
+    rain_IPH 或 rain_event 大於 0 的資料列視為降雨中；間隔不超過 gap 的降雨列屬於同一個事件。
+    總雨量優先使用雨量計的事件累積雨量，沒有時以雨量強度對時間積分。
+    """
+    if not has_rain(sheet):
+        return pd.DataFrame(columns=event_columns).set_index('開始', drop=False)
+
+    t = sheet['時間']
+    intensity = sheet['rain_IPH'].fillna(0)
+    accumulated = sheet['rain_event'].fillna(0)
+    # 每列代表的時數，資料中斷時最多算一小時
+    hours = t.diff().dt.total_seconds().div(3600).clip(upper=1).fillna(0)
+
+    wet = (intensity > 0) | (accumulated > 0)
+    rows = pd.DataFrame({
+        '時間': t[wet],
+        '事件雨量': accumulated[wet],
+        '積分雨量': (intensity * hours)[wet],
+        '最大雨量強度': intensity[wet],
+    })
+    event_id = (rows['時間'].diff() > gap).cumsum()
+
+    events = rows.groupby(event_id).agg(
+        開始=('時間', "min"),
+        結束=('時間', "max"),
+        事件雨量=('事件雨量', "max"),
+        積分雨量=('積分雨量', "sum"),
+        最大雨量強度=('最大雨量強度', "max"),
+    )
+    events['時數'] = (events['結束'] - events['開始']).dt.total_seconds() / 3600
+    events['總雨量'] = events['事件雨量'].where(
+        events['事件雨量'] > 0, events['積分雨量'])
+    return events[event_columns].set_index('開始', drop=False)
+
+
+def slice_events(events: pd.DataFrame, m, M) -> pd.DataFrame:
+    """
+    取出與 m 到 M（包含）日期區間重疊的事件
+    """
+    start = pd.Timestamp(m)
+    end = pd.Timestamp(M) + pd.Timedelta(days=1)
+    return events.loc[(events['結束'] >= start) & (events['開始'] < end)]
+
+
+def event_response(sheet: pd.DataFrame, events: pd.DataFrame, column: str, hours: float = 24):
+    """
+    每個事件開始後 hours 小時內 column 相對於開始前的變化
+
+    以二分搜尋只切取每個事件前後的資料列。回傳 (曲線, 摘要)：
+    曲線為 {事件開始時間: 以事件開始後時數為索引的變化量}，
+    摘要為每個事件的開始前數值、最大增加量與達到最大值的時數。
+    """
+    t = sheet['時間'].to_numpy()
+    values = sheet[column].to_numpy(dtype="float64")
+    window = pd.Timedelta(hours=hours)
+
+    curves = dict()
+    summary = list()
+    for start in events['開始']:
+        begin = np.searchsorted(t, np.datetime64(start), side="left")
+        end = np.searchsorted(t, np.datetime64(start + window), side="right")
+        before = values[max(begin - 12, 0):begin]
+        before = before[~np.isnan(before)]
+        if begin >= end or len(before) == 0:
+            continue
+
+        baseline = before[-1]
+        delta = values[begin:end] - baseline
+        elapsed = (t[begin:end] - np.datetime64(start)) / np.timedelta64(1, "h")
+        curves[start] = pd.Series(delta, index=elapsed)
+
+        peak = np.nanargmax(delta) if not np.isnan(delta).all() else None
+        summary.append({
+            '開始': start,
+            '開始前' + column: baseline,
+            '最大增加量': np.nan if peak is None else delta[peak],
+            '達到最大值時數': np.nan if peak is None else elapsed[peak],
+        })
+
+    return curves, pd.DataFrame(summary)
@@ -0,0 +1,62 @@
+import time
+from shiny import reactive
+
+
+def debounce(delay_secs: float):
+    """
+    debounce 裝飾器
+
+    被裝飾的函式（通常只讀取 input）改變後，要等 delay_secs 秒內沒有再改變，
+    依賴它的 reactive calc 與輸出才會重新計算；連續的輸入變動只會觸發一次計算。
+    第一次取值不延遲。
+
+    @debounce(.5)
+    def inputs():
+        return input.variable_select(), input.input_date_range()
+    """
+    def wrapper(f):
+        when = reactive.Value(None)
+        trigger = reactive.Value(0)
+
+        @reactive.Calc
+        def cached():
+            return f()
+
+        first = True
+
+        # 每次輸入改變都把期限往後延；第一次取值已由 debounced 直接計算
+        @reactive.Effect(priority=102)
+        def primer():
+            nonlocal first
+            try:
+                cached()
+            except Exception:
+                pass
+            finally:
+                if first:
+                    first = False
+                else:
+                    when.set(time.time() + delay_secs)
+
+        # 期限到了才通知下游
+        @reactive.Effect(priority=101)
+        def timer():
+            deadline = when()
+            if deadline is None:
+                return
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_none=False)
+        def debounced():
+            return cached()
+
+        return debounced
+
+    return wrapper
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+# 以充分統計量做的簡單線性迴歸
+#
+# 每一對變數只需在表格版本改變時計算一次每日的部分和；任意日期區間或月份的迴歸
+# 都由部分和相加得到，不需要重新讀取原始資料列。
+
+moment_columns = ["n", "sx", "sy", "sxx", "syy", "sxy", "xmin", "xmax"]
+
+
+def daily_moments(x: pd.Series, y: pd.Series) -> pd.DataFrame:
+    """
+    計算兩個以時間為索引的序列每日的部分和
+
+    只使用兩者都有值的時間點；回傳以日期為索引、欄位為 moment_columns 的資料框。
+    平方和與乘積和以 float64 累加。
+    """
+    x, y = x.astype("float64").align(y.astype("float64"), join="inner")
+    valid = x.notna() & y.notna()
+    x, y = x[valid], y[valid]
+
+    df = pd.DataFrame({
+        "n": 1,
+        "sx": x,
+        "sy": y,
+        "sxx": x * x,
+        "syy": y * y,
+        "sxy": x * y,
+    })
+    grouped = df.groupby(x.index.floor("D"))
+    moments = grouped.sum()
+    moments["xmin"] = grouped["sx"].min()
+    moments["xmax"] = grouped["sx"].max()
+    moments.index.name = "日期"
+    return moments[moment_columns]
+
+
+def merge_moments(moments: pd.DataFrame) -> pd.Series:
+    """
+    合併多日的部分和
+    """
+    merged = moments[["n", "sx", "sy", "sxx", "syy", "sxy"]].sum()
+    merged["xmin"] = moments["xmin"].min()
+    merged["xmax"] = moments["xmax"].max()
+    return merged
+
+
+def fit_moments(moments: pd.Series) -> dict:
+    """
+    由合併後的部分和求斜率、截距與 R²；資料不足或 x 沒有變化時回傳 None
+    """
+    n = moments["n"]
+    if n < 2:
+        return None
+    sxx = moments["sxx"] - moments["sx"] ** 2 / n
+    syy = moments["syy"] - moments["sy"] ** 2 / n
+    sxy = moments["sxy"] - moments["sx"] * moments["sy"] / n
+    if sxx <= 0:
+        return None
+
+    slope = sxy / sxx
+    intercept = (moments["sy"] - slope * moments["sx"]) / n
+    r2 = sxy ** 2 / (sxx * syy) if syy > 0 else np.nan
+    return {
+        "n": int(n),
+        "slope": slope,
+        "intercept": intercept,
+        "r2": r2,
+        "xmin": moments["xmin"],
+        "xmax": moments["xmax"],
+    }
+
+
+def fit_by_month(moments: pd.DataFrame) -> dict:
+    """
+    每個月份分別擬合，回傳 {YYYY-MM: fit_moments 的結果}
+    """
+    months = moments.index.strftime("%Y-%m")
+    fits = dict()
+    for month, rows in moments.groupby(months):
+        fit = fit_moments(merge_moments(rows))
+        if fit is not None:
+            fits[month] = fit
+    return fits
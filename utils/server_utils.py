@@ -1,19 +1,19 @@
 import numpy as np
 import pandas as pd
-from config import sheet_config, sheet_url
-from shiny.reactive import Value
-from shiny import ui
+from config import sheet_config, sheet_url, store_config
+from utils.derived_utils import get_derived_variables
 
-def load_sheet(location: str) -> pd.DataFrame:
-    """
-    讀取表格
+# 量測值的儲存型別
+# [store] compact = true 時以 float32 儲存，表格與彙總快取的記憶體減半；
+# 感測器精度最多到小數第二位，float32 約 7 位有效數字已足夠。
+# 重新取樣、統計與迴歸等需要累加的計算以 as_float64 轉回 float64 後進行。
+measurement_dtype = "float32" if store_config.get("compact", False) else "float64"
 
+def get_sheet_columns(location: str) -> list:
     """
-    csv_url = f"{sheet_url}/export?format=csv&gid={sheet_config.get(location)}"
-
-    df = pd.read_csv(csv_url, dtype=str)
-    df.replace(["999", "TO", "undefined", "", "NA"], np.nan, inplace=True)
+    取得表格中量測值欄位的名稱（不含時間）
 
+    """
     common_cols = ['氣壓', '氣溫', '空氣相對溼度', '光強度', '風向', '風速']
     soil = ['土壤溫度', '土壤濕度', '土壤電導度']
 
@@ -28,27 +28,53 @@ def load_sheet(location: str) -> pd.DataFrame:
         rain_cols = ['雨量', 'rain_event', 'rain_totalevent', 'rain_IPH']
         new_cols = common_cols + soil_cols + rain_cols
 
-    df = df.assign(**df[new_cols].astype("float64"))
+    return new_cols
+
+
+def parse_sheet(df: pd.DataFrame, location: str) -> pd.DataFrame:
+    """
+    將字串欄位轉成表格的欄位格式
+
+    """
+    df = df.replace(["999", "TO", "undefined", "", "NA"], np.nan)
+
+    new_cols = get_sheet_columns(location)
+    df = df.assign(**df[new_cols].astype(measurement_dtype))
     new_cols = ['時間'] + new_cols
     df = df[new_cols]
 
     df['時間'] = pd.to_datetime(df['時間'], format='%Y-%m-%d %H:%M:%S')
+    return df
+
+
+def load_sheet(location: str) -> pd.DataFrame:
+    """
+    讀取表格
+
+    """
+    csv_url = f"{sheet_url}/export?format=csv&gid={sheet_config.get(location)}"
+
+    df = parse_sheet(pd.read_csv(csv_url, dtype=str), location)
     print(f"sheet {location} loaded successfully!")
     return df
 
-def reload_all(indoor_sheet: Value, outdoor_sheet: Value):
+def as_float64(df: pd.DataFrame, rounded: bool = False) -> pd.DataFrame:
     """
-    重新讀取所有表格
+    將 float32 欄位轉成 float64，沒有 float32 欄位時直接回傳原資料框
 
+    rounded 為 True 時捨入到 float32 的有效位數，輸出 JSON 時才不會出現 25.1000003815
     """
-    with ui.Progress() as p:
-        p.set(message="讀取檔案", detail="這需要花一點時間...")
-        indoor_sheet.set(load_sheet("indoor"))
-        p.inc(amount=.5, detail="讀取中")
-        outdoor_sheet.set(load_sheet("outdoor"))
-        p.inc(amount=.5)
-        p.set(message="完成！", detail="")
-    
+    columns = df.select_dtypes("float32").columns
+    if len(columns) == 0:
+        return df
+
+    values = df[columns].to_numpy(dtype="float64")
+    if rounded:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            digits = 6 - np.floor(np.log10(np.abs(values)))
+        scale = 10.0 ** np.nan_to_num(digits, nan=0, posinf=0, neginf=0)
+        values = np.round(values * scale) / scale
+    return df.assign(**dict(zip(columns, values.T)))
 
 
 def expand_soil_cols(cols):
@@ -94,13 +120,78 @@ def get_date_range(sheet: pd.DataFrame):
     return m, M
 
 
-def get_variables(sheet: pd.DataFrame):
+def slice_date_range(sheet: pd.DataFrame, m, M) -> pd.DataFrame:
+    """
+    取出資料框中介於兩個日期（包含）之間的列
+    """
+    dates = sheet['時間'].dt.date
+    return sheet.loc[(dates >= m) & (dates <= M)]
+
+
+def get_variables(sheet: pd.DataFrame, derived: bool = False):
     """
     取得資料框除了時間以外的所有變數名稱
+    derived 為 True 時一併列出可推導的虛擬變數
     """
-    return sheet.columns.drop('時間').tolist()
+    variables = sheet.columns.drop('時間').tolist()
+    if derived:
+        variables += get_derived_variables(sheet)
+    return variables
+
+def daily_statistics(sheet: pd.DataFrame) -> pd.DataFrame:
+    """
+    每日各變數的資料列數、筆數（非缺失）、缺失比例、最小值、平均值、最大值與標準差
+
+    所有變數以同一個依日期的 groupby 一次計算，結果依變數、日期排序
+    """
+    values = as_float64(sheet.drop(columns='時間'))
+    grouped = values.groupby(sheet['時間'].dt.floor('D'))
+    stats = grouped.agg(["count", "min", "mean", "max", "std"])
+    size = grouped.size()
+
+    daily = pd.concat(
+        {column: stats[column] for column in values.columns},
+        names=['變數', '日期'],
+    ).reset_index()
+    daily.columns = ['變數', '日期', '筆數', '最小值', '平均值', '最大值', '標準差']
+    daily.insert(2, '資料列數', size.reindex(daily['日期']).to_numpy())
+    daily.insert(4, '缺失比例', 1 - daily['筆數'] / daily['資料列數'])
+    return daily
+
+
+def summarize_daily_statistics(daily: pd.DataFrame) -> pd.DataFrame:
+    """
+    將 daily_statistics 的多日結果合併成每個變數一列
+
+    平均值與標準差由每日的總和與平方和合併，不需要重新讀取原始資料
+    """
+    n = daily['筆數']
+    total = (daily['平均值'] * n).fillna(0)
+    squares = (daily['標準差'].fillna(0) ** 2 * (n - 1).clip(lower=0)
+               + daily['平均值'].fillna(0) ** 2 * n)
+
+    summary = daily.assign(總和=total, 平方和=squares) \
+        .groupby('變數', sort=False) \
+        .agg({
+            '資料列數': "sum",
+            '筆數': "sum",
+            '最小值': "min",
+            '最大值': "max",
+            '總和': "sum",
+            '平方和': "sum",
+        })
+
+    n = summary['筆數']
+    mean = summary['總和'] / n.where(n > 0)
+    variance = (summary['平方和'] - n * mean ** 2) / (n - 1).where(n > 1)
+    summary['缺失比例'] = 1 - n / summary['資料列數']
+    summary['平均值'] = mean
+    summary['標準差'] = np.sqrt(variance.clip(lower=0))
+    return summary.reset_index()[
+        ['變數', '資料列數', '筆數', '缺失比例', '最小值', '平均值', '最大值', '標準差']]
+
 
 def convert_epoch_to_strftime(df: pd.DataFrame):
-    df_ = df.copy()
+    df_ = as_float64(df, rounded=True).copy()
     df_['時間'] = df['時間'].dt.strftime('%Y/%m/%d %H:%M:%S')
     return df_
\ No newline at end of file
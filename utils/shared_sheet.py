@@ -0,0 +1,299 @@
+import json
+import os
+import struct
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from multiprocessing import resource_tracker, shared_memory
+
+# 以 multiprocessing.shared_memory 在多個 worker 之間共用表格
+#
+# 每個位置有一個固定名稱的 manifest 區塊，記錄目前版本的資料區塊名稱與欄位配置；
+# 資料區塊中量測值欄位存成一個連續的二維陣列，時間欄位存成 int64 epoch（奈秒），
+# worker 直接以 numpy view 建立 DataFrame，不需複製。
+#
+# worker 收到的推送資料寫入 spool 目錄，由 loader 合併進表格後發布，
+# 因此只有 loader 會修改表格。
+
+prefix = "daxi_farm_sensor"
+
+manifest_size = 64 * 1024
+
+# manifest 開頭：序號（奇數代表寫入中）、JSON 長度
+header = struct.Struct("<QQ")
+
+
+def manifest_name(location: str) -> str:
+    return f"{prefix}_{location}"
+
+
+def segment_name(location: str, version: int) -> str:
+    return f"{prefix}_{location}_v{version}"
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """
+    連接既有的共享記憶體區塊
+
+    連接端不負責刪除區塊，因此從 resource tracker 取消註冊，
+    避免 worker 結束時把 loader 發布的區塊一併刪除。
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def write_manifest(manifest: shared_memory.SharedMemory, info: dict):
+    body = json.dumps(info, ensure_ascii=False).encode()
+    if header.size + len(body) > manifest_size:
+        raise ValueError("manifest too large")
+
+    seq, _ = header.unpack_from(manifest.buf, 0)
+    seq += 1 if seq % 2 == 0 else 0
+    header.pack_into(manifest.buf, 0, seq, 0)
+    manifest.buf[header.size:header.size + len(body)] = body
+    header.pack_into(manifest.buf, 0, seq + 1, len(body))
+
+
+def read_manifest(manifest: shared_memory.SharedMemory) -> dict:
+    """
+    讀取 manifest；寫入中或讀取期間被更新時重試
+    """
+    while True:
+        seq, length = header.unpack_from(manifest.buf, 0)
+        if seq % 2 == 1 or length == 0:
+            time.sleep(.01)
+            continue
+        body = bytes(manifest.buf[header.size:header.size + length])
+        if header.unpack_from(manifest.buf, 0)[0] == seq:
+            return json.loads(body)
+
+
+class SheetPublisher:
+    """
+    loader 行程：把讀取好的表格發布到共享記憶體
+    """
+
+    def __init__(self):
+        self._manifests = dict()
+        self._segments = dict()
+
+    def publish(self, location: str, df: pd.DataFrame, version: int):
+        columns = df.columns.drop('時間').tolist()
+        values = df[columns].to_numpy().T
+        epoch = df['時間'].to_numpy().view("int64")
+
+        size = epoch.nbytes + values.nbytes
+        segment = shared_memory.SharedMemory(
+            name=segment_name(location, version), create=True, size=max(size, 1))
+        np.ndarray(epoch.shape, epoch.dtype, segment.buf)[:] = epoch
+        np.ndarray(values.shape, values.dtype, segment.buf,
+                   offset=epoch.nbytes)[:] = values
+
+        if location not in self._manifests:
+            try:
+                manifest = shared_memory.SharedMemory(
+                    name=manifest_name(location), create=True, size=manifest_size)
+            except FileExistsError:
+                manifest = shared_memory.SharedMemory(
+                    name=manifest_name(location))
+            self._manifests[location] = manifest
+
+        write_manifest(self._manifests[location], {
+            "version": version,
+            "segment": segment.name,
+            "rows": len(df),
+            "columns": columns,
+            "dtype": values.dtype.str,
+            "loaded_at": time.time(),
+        })
+
+        # 已連接舊版本的 worker 仍可使用原本的對應，刪除只會移除名稱
+        old = self._segments.get(location)
+        if old is not None:
+            old.close()
+            old.unlink()
+        self._segments[location] = segment
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+            segment.unlink()
+        for manifest in self._manifests.values():
+            manifest.close()
+            manifest.unlink()
+
+
+class SheetSubscriber:
+    """
+    worker 行程：以 zero-copy 方式讀取 loader 發布的表格
+    """
+
+    def __init__(self):
+        self._segments = dict()
+        self._retired = list()
+
+    def version(self, location: str):
+        """
+        目前發布的版本；loader 尚未發布時為 None
+        """
+        try:
+            manifest = attach(manifest_name(location))
+        except FileNotFoundError:
+            return None
+        try:
+            return read_manifest(manifest)["version"]
+        finally:
+            manifest.close()
+
+    def load(self, location: str):
+        """
+        連接目前發布的版本，回傳 (版本, 讀取時間, DataFrame)
+        """
+        manifest = attach(manifest_name(location))
+        try:
+            while True:
+                info = read_manifest(manifest)
+                try:
+                    segment = attach(info["segment"])
+                    break
+                except FileNotFoundError:
+                    # 讀取 manifest 後 loader 又發布了新版本
+                    continue
+        finally:
+            manifest.close()
+
+        rows = info["rows"]
+        columns = info["columns"]
+        # np.frombuffer 會持有區塊的 buffer，仍有 DataFrame 參照時區塊無法被關閉
+        epoch = np.frombuffer(segment.buf, "int64", rows)
+        values = np.frombuffer(segment.buf, info["dtype"], len(columns) * rows,
+                               offset=epoch.nbytes).reshape(len(columns), rows)
+        # 所有 worker 共用同一塊記憶體，任何原地修改都會破壞其他 worker 的資料
+        epoch.flags.writeable = False
+        values.flags.writeable = False
+
+        df = pd.concat(
+            [
+                pd.DataFrame({'時間': epoch.view("M8[ns]")}, copy=False),
+                pd.DataFrame(values.T, columns=columns, copy=False),
+            ],
+            axis=1,
+            copy=False,
+        )
+
+        self._swap(location, segment)
+        return info["version"], info["loaded_at"], df
+
+    def _swap(self, location: str, segment: shared_memory.SharedMemory):
+        """
+        換成新版本的區塊；舊區塊等到沒有任何 DataFrame 參照時才關閉
+        """
+        old = self._segments.get(location)
+        self._segments[location] = segment
+        if old is not None:
+            self._retired.append(old)
+
+        retired = list()
+        for i in self._retired:
+            try:
+                i.close()
+            except BufferError:
+                retired.append(i)
+        self._retired = retired
+
+
+class SheetSpool:
+    """
+    worker 推送、loader 取出的資料列佇列
+
+    每次推送寫成 <目錄>/<位置>/ 下的一個檔案，先寫入暫存檔再改名，
+    loader 只會讀到完整的檔案。
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def put(self, location: str, rows: pd.DataFrame):
+        directory = self.directory / location
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}"
+        rows.to_pickle(directory / f"{name}.tmp")
+        os.replace(directory / f"{name}.tmp", directory / f"{name}.pkl")
+
+    def drain(self, location: str) -> pd.DataFrame | None:
+        """
+        取出某位置所有等待中的資料列並刪除檔案；沒有資料時回傳 None
+        """
+        files = sorted((self.directory / location).glob("*.pkl"))
+        if not files:
+            return None
+        rows = pd.concat([pd.read_pickle(i) for i in files], ignore_index=True)
+        for i in files:
+            i.unlink()
+        return rows
+
+
+def main():
+    """
+    loader 行程進入點
+
+    python -m utils.shared_sheet [每次重新讀取的間隔秒數]
+
+    每隔指定秒數重新讀取表格，其間每秒合併 worker 寫入 spool 的推送資料；
+    只有表格改變的位置會發布新版本。表格更新後評估警示規則。
+    """
+    import sys
+    from config import alert_config, root_dir, store_config
+    from utils.alert_utils import create_engine
+    from utils.archive_utils import BatchedArchiveWriter
+    from utils.sheet_store import SheetStore, archive
+
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 300
+    spool = SheetSpool(store_config.get("spool_dir", root_dir / "spool"))
+
+    sheets = SheetStore(archive=archive)
+    if archive is not None:
+        sheets.on_refresh(BatchedArchiveWriter(
+            archive, delay=store_config.get("archive_delay", 30)).submit)
+
+    # 警示規則只在 loader 評估，沒有使用者連線時也會檢查
+    engine = create_engine(alert_config)
+
+    @sheets.on_refresh
+    def evaluate_alerts(tables: dict):
+        for location, sheet in tables.items():
+            engine.evaluate(location, sheet)
+
+    publisher = SheetPublisher()
+    published = dict()
+    version = int(time.time())
+    next_load = 0
+    try:
+        while True:
+            if time.monotonic() >= next_load:
+                sheets.refresh()
+                next_load = time.monotonic() + interval
+            for location in sheets.locations:
+                rows = spool.drain(location)
+                if rows is not None:
+                    sheets.append(location, rows)
+
+            changed = [i for i in sheets.locations
+                       if sheets.get(i) is not published.get(i)]
+            if changed:
+                for location in changed:
+                    published[location] = sheets.get(location)
+                    publisher.publish(location, published[location], version)
+                print(f"sheet version {version} published.")
+                version += 1
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+import threading
+import time
+import pandas as pd
+from shiny import ui
+from shiny.reactive import Value
+from config import root_dir, sensor_info, store_config
+from utils.server_utils import as_float64, daily_statistics, get_date_range, load_sheet, \
+    measurement_dtype, slice_date_range
+from utils.derived_utils import compute_derived, derived_variables, season_start, \
+    seasonal_variables
+from utils.archive_utils import BatchedArchiveWriter, SheetArchive
+from utils.shared_sheet import SheetSpool, SheetSubscriber
+from utils.regression_utils import daily_moments
+from utils.rain_utils import rain_events
+from utils.forecast_utils import SoilMoistureForecaster
+
+# 可用的取樣頻率與對應的 resample 規則
+frequencies = {
+    "default": None,
+    "hour": "H",
+    "day": "D",
+}
+
+
+class SheetStore:
+    """
+    全域表格快取
+
+    所有 session 與資料 API 共用同一份表格，表格只會讀取一次；
+    由表格衍生的資料（例如每小時、每日平均）依表格版本快取。
+    """
+
+    def __init__(self, loader=load_sheet, archive: SheetArchive = None):
+        self._loader = loader
+        self.archive = archive
+        self._lock = threading.RLock()
+        self._sheets = dict()
+        self._cache = dict()
+        self._listeners = list()
+        self.version = 0
+        self.loaded_at = None
+        self._season_rows = dict()
+        # (版本, 位置, 該版本改變的最早時間)，供增量更新 pair_moments
+        self._changes = list()
+        self._changes_trimmed = 0
+        self._moments = dict()
+        self.forecaster = SoilMoistureForecaster(
+            horizon=store_config.get("forecast_hours", 48))
+
+    @property
+    def locations(self):
+        return list(sensor_info.keys())
+
+    def on_refresh(self, fn):
+        """
+        註冊表格更新後要執行的函式，fn 會收到 {位置: 表格}
+        """
+        self._listeners.append(fn)
+        return fn
+
+    def _notify(self):
+        for fn in self._listeners:
+            fn(dict(self._sheets))
+
+    def refresh(self):
+        """
+        重新讀取所有表格並遞增版本
+        """
+        sheets = {location: self._loader(location)
+                  for location in self.locations}
+        with self._lock:
+            # 保留推送進來、但還沒出現在表格中的較新資料列
+            for location, sheet in self._sheets.items():
+                pushed = sheet.loc[sheet['時間'] > sheets[location]['時間'].max()]
+                if not pushed.empty:
+                    sheets[location] = pd.concat(
+                        [sheets[location], pushed], ignore_index=True)
+            self._sheets = sheets
+            self._cache = dict()
+            self.version += 1
+            self.loaded_at = time.time()
+            # 重新讀取的表格可能改變任何一列，封存中較早的資料不受影響
+            for location, sheet in sheets.items():
+                self._record_change(location, sheet['時間'].min())
+        self._notify()
+
+    def ensure_loaded(self):
+        """
+        表格尚未讀取時才讀取
+        """
+        with self._lock:
+            if self.version == 0:
+                self.refresh()
+
+    def append(self, location: str, rows: pd.DataFrame) -> tuple:
+        """
+        附加推送的資料列，只保留比表格最後一筆新的列
+
+        回傳 (實際附加的列數, 不晚於表格最後一筆而被丟棄的列數)
+        """
+        self.ensure_loaded()
+        with self._lock:
+            sheet = self._sheets[location]
+            newer = rows['時間'] > sheet['時間'].max()
+            older = int((~newer).sum())
+            rows = rows.loc[newer] \
+                .sort_values('時間') \
+                .drop_duplicates('時間', keep="last")
+            if rows.empty:
+                return 0, older
+            sheets = dict(self._sheets)
+            sheets[location] = pd.concat([sheet, rows], ignore_index=True)
+            self._sheets = sheets
+            self._invalidate([location])
+            self._record_change(location, rows['時間'].min())
+            self.loaded_at = time.time()
+        self._notify()
+        return len(rows), older
+
+    def _invalidate(self, locations: list, version: int = None):
+        """
+        換成新版本（預設為目前版本加一），只丟棄與 locations 有關的快取，
+        其他位置的快取沿用到新版本
+
+        快取的 key 都包含位置名稱。
+        """
+        previous = self.version
+        self.version = previous + 1 if version is None else version
+        self._cache = {
+            (self.version, key): value
+            for (cached_version, key), value in self._cache.items()
+            if cached_version == previous and not any(i in key for i in locations)
+        }
+
+    def _record_change(self, location: str, since: pd.Timestamp, keep: int = 1000):
+        """
+        記錄目前版本中 location 從 since 起的資料可能改變
+        """
+        self._changes.append((self.version, location, since))
+        if len(self._changes) > keep:
+            self._changes_trimmed = self._changes[-keep - 1][0]
+            self._changes = self._changes[-keep:]
+
+    def _changed_since(self, version: int, locations: list) -> pd.Timestamp | None:
+        """
+        version 之後 locations 最早改變的時間；沒有改變時為 pd.Timestamp.max，
+        紀錄已被截斷而無法判斷時為 None
+        """
+        if version < self._changes_trimmed:
+            return None
+        times = [since for changed, location, since in self._changes
+                 if changed > version and location in locations]
+        return min(times) if times else pd.Timestamp.max
+
+    def poll_version(self) -> int:
+        """
+        目前的表格版本，供 session 偵測其他 session 或推送造成的更新
+        """
+        self.ensure_loaded()
+        return self.version
+
+    def get(self, location: str) -> pd.DataFrame:
+        """
+        取得某位置的原始表格（共用物件，請勿原地修改）
+        """
+        self.ensure_loaded()
+        if location not in self._sheets:
+            raise KeyError(location)
+        return self._sheets[location]
+
+    def cached(self, key, fn):
+        """
+        依表格版本快取 fn() 的結果
+        """
+        with self._lock:
+            version = self.version
+            if (version, key) not in self._cache:
+                self._cache[(version, key)] = fn()
+            return self._cache[(version, key)]
+
+    def rollup(self, location: str, frequency: str) -> pd.DataFrame:
+        """
+        取得某位置在特定頻率下的平均值表格，欄位與原始表格相同
+
+        平均以 float64 計算，結果再存成與原始表格相同的型別。
+        """
+        rule = frequencies[frequency]
+        if rule is None:
+            return self.get(location)
+
+        def compute():
+            df = as_float64(self.get(location))
+            df = df.resample(rule, on='時間').mean().reset_index()
+            return df.astype({i: measurement_dtype for i in df.columns.drop('時間')})
+
+        return self.cached(("rollup", location, frequency), compute)
+
+    def daily_statistics(self, location: str) -> pd.DataFrame:
+        """
+        取得某位置每個變數的每日統計，查詢日期區間時只需切片這張表
+        """
+        return self.cached(("daily_statistics", location),
+                           lambda: daily_statistics(self.get(location)))
+
+    def derived(self, location: str, frequency: str, name: str) -> pd.Series:
+        """
+        取得虛擬變數，索引與 rollup(location, frequency) 相同
+
+        第一次取用時才計算；非預設頻率取原始資料推導值的平均。
+        """
+        rule = frequencies[frequency]
+
+        def compute():
+            df = self.get(location)
+            series = self._compute_seasonal(location, df, name)
+            if rule is None:
+                return series
+            series.index = df['時間']
+            return series.resample(rule).mean().reset_index(drop=True)
+
+        return self.cached(("derived", location, frequency, name), compute)
+
+    def _compute_seasonal(self, location: str, sheet: pd.DataFrame, name: str) -> pd.Series:
+        """
+        計算表格的虛擬變數；季節累積的變數先補上封存中同一季節、早於表格的資料列
+
+        補上的資料列依表格第一筆的時間快取，表格輪替後才重新讀取封存。
+        """
+        if name not in seasonal_variables or self.archive is None:
+            return compute_derived(sheet, name)
+
+        required = derived_variables[name][0]
+        first = sheet['時間'].min()
+        key = (location, name)
+        cached = self._season_rows.get(key)
+        if cached is None or cached[0] != first:
+            earlier = self.archive.query(
+                location, season_start(first).date(), first.date(), required)
+            earlier = earlier.loc[earlier['時間'] < first]
+            self._season_rows[key] = cached = (first, earlier)
+
+        earlier = cached[1]
+        df = pd.concat([earlier, sheet[['時間'] + required]], ignore_index=True)
+        values = compute_derived(df, name).to_numpy()[len(earlier):]
+        return pd.Series(values, index=sheet.index, name=name)
+
+    def forecast(self, location: str) -> pd.DataFrame:
+        """
+        某位置各土壤濕度感測器未來的預測值（見 utils.forecast_utils）
+
+        模型在每個表格版本增量更新一次，所有 session 共用同一份預測。
+        """
+        return self.cached(
+            ("forecast", location),
+            lambda: self.forecaster.forecast(
+                location, as_float64(self.rollup(location, "hour"))))
+
+    def rain_events(self, location: str) -> pd.DataFrame:
+        """
+        某位置的降雨事件表（見 utils.rain_utils），沒有雨量計時為空表
+        """
+        return self.cached(("rain_events", location),
+                           lambda: rain_events(self.get(location)))
+
+    def pair_moments(self, location1: str, column1: str, location2: str, column2: str, frequency: str) -> pd.DataFrame:
+        """
+        兩個變數在某頻率下依時間對齊後每日的部分和（n、Σx、Σy、Σx²、Σy²、Σxy）
+
+        每對變數依表格版本只計算一次，任意日期區間的迴歸只需切片後相加。
+        新版本沿用前一次計算的結果，只重新計算兩個位置最早改變的那一天之後的部分和。
+        """
+        key = ("pair_moments", location1, column1, location2, column2, frequency)
+
+        def compute():
+            previous = self._moments.get(key)
+            since = None
+            if previous is not None:
+                since = self._changed_since(previous[0], [location1, location2])
+            if since == pd.Timestamp.max:
+                moments = previous[1]
+            else:
+                start = None if since is None else since.floor('D')
+                series = list()
+                for location, column in [(location1, column1), (location2, column2)]:
+                    m, M = self.date_range(location)
+                    if start is not None:
+                        m = max(m, start.date())
+                    df = self.select(location, frequency, m, M, [column])
+                    series.append(df.set_index('時間')[column])
+                moments = daily_moments(*series)
+                if start is not None:
+                    kept = previous[1].loc[previous[1].index < start]
+                    moments = pd.concat([kept, moments])
+            self._moments[key] = (self.version, moments)
+            return moments
+
+        return self.cached(key, compute)
+
+    def date_range(self, location: str):
+        """
+        可查詢的日期區間，包含已移出表格的封存資料
+        """
+        m, M = get_date_range(self.get(location))
+        if self.archive is not None:
+            archived = self.archive.date_range(location)
+            if archived is not None:
+                m, M = min(m, archived[0]), max(M, archived[1])
+        return m, M
+
+    def history(self, location: str, frequency: str, m, M, columns: list):
+        """
+        從封存讀取比目前表格更早的資料，只開啟與區間重疊的月份；沒有時回傳 None
+
+        與表格第一筆資料落在同一個取樣區間的封存資料列不列入，避免區間重複。
+        """
+        if self.archive is None:
+            return None
+        rule = frequencies[frequency]
+        first = self.get(location)['時間'].min()
+        if rule is not None:
+            first = first.floor(rule)
+        if pd.Timestamp(m) >= first:
+            return None
+
+        needed = list()
+        for name in columns:
+            needed += derived_variables[name][0] \
+                if name in derived_variables else [name]
+        needed = list(dict.fromkeys(needed))
+
+        # 季節累積的變數需要從季節起始日開始讀取，計算後再切掉 m 之前的資料列
+        start = m
+        if any(i in seasonal_variables for i in columns):
+            start = min(m, season_start(m).date())
+        df = self.archive.query(location, start, min(M, first.date()), needed)
+        if df.empty:
+            return None
+        df = df.loc[df['時間'] < first]
+        for name in columns:
+            if name not in df.columns:
+                df[name] = compute_derived(df, name)
+        df = df.loc[df['時間'] >= pd.Timestamp(m)]
+        if df.empty:
+            return None
+        if rule is not None:
+            df = as_float64(df).resample(rule, on='時間').mean().reset_index()
+        return df[['時間'] + list(columns)]
+
+    def select(self, location: str, frequency: str, m, M, columns: list) -> pd.DataFrame:
+        """
+        取得日期區間內的時間與指定欄位，欄位可以是虛擬變數
+
+        區間早於目前表格時，較早的部分由封存補上。
+        """
+        df = slice_date_range(self.rollup(location, frequency), m, M)
+        real = [i for i in columns if i in df.columns]
+        df = df[['時間'] + real]
+        for name in columns:
+            if name not in real:
+                df[name] = self.derived(location, frequency, name) \
+                    .reindex(df.index)
+        df = df[['時間'] + list(columns)]
+
+        history = self.history(location, frequency, m, M, columns)
+        if history is not None:
+            df = pd.concat([history, df], ignore_index=True)
+        return df
+
+
+class SharedSheetStore(SheetStore):
+    """
+    多個 worker 共用的表格快取
+
+    表格由獨立的 loader 行程（python -m utils.shared_sheet）讀取並發布到共享記憶體，
+    worker 只連接已發布的版本；loader 發布新版本後，下一次取用表格時自動切換。
+    推送的資料列寫入 spool 目錄，由 loader 合併後隨下一個版本發布。
+    於 secrets.toml 設定 [store] shared_memory = true 啟用。
+    """
+
+    def __init__(self, archive: SheetArchive = None, spool: SheetSpool = None):
+        super().__init__(archive=archive)
+        self.spool = spool
+        self._subscriber = SheetSubscriber()
+        self._published = dict()
+
+    def _published_versions(self) -> dict:
+        return {location: self._subscriber.version(location)
+                for location in self.locations}
+
+    def refresh(self):
+        """
+        切換到 loader 目前發布的版本；沒有重新發布的位置沿用原本的表格與快取
+        """
+        sheets = dict(self._sheets)
+        published = dict(self._published)
+        loaded_at = list()
+        for location, version in self._published_versions().items():
+            if version is not None and version != published.get(location):
+                published[location], at, sheets[location] = \
+                    self._subscriber.load(location)
+                loaded_at.append(at)
+        changed = [i for i in published if published[i] != self._published.get(i)]
+        if not changed:
+            return
+
+        with self._lock:
+            self._sheets = sheets
+            self._published = published
+            # 各位置發布版本的總和：任一位置更新就會增加，且每個 worker 都相同
+            self._invalidate(changed, version=sum(published.values()))
+            for location in changed:
+                self._record_change(location, sheets[location]['時間'].min())
+            self.loaded_at = max(loaded_at)
+        self._notify()
+
+    def append(self, location: str, rows: pd.DataFrame) -> tuple:
+        """
+        把比目前表格新的資料列交給 loader，回傳 (排入的列數, 被丟棄的較舊列數)
+        """
+        self.ensure_loaded()
+        newer = rows['時間'] > self.get(location)['時間'].max()
+        if newer.any():
+            self.spool.put(location, rows.loc[newer])
+        return int(newer.sum()), int((~newer).sum())
+
+    def ensure_loaded(self):
+        published = self._published_versions()
+        if None in published.values():
+            raise RuntimeError("no sheet has been published yet")
+        with self._lock:
+            if published != self._published:
+                self.refresh()
+
+
+def refresh_periodically(store: SheetStore, interval: float) -> threading.Thread:
+    """
+    在背景每隔 interval 秒重新讀取表格；讀取失敗時沿用原本的表格，下次再試
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                store.refresh()
+            except Exception as e:
+                print(f"periodic refresh failed: {e!r}")
+
+    thread = threading.Thread(target=run, name="sheet-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+archive = None
+if store_config.get("archive", True):
+    archive = SheetArchive(store_config.get("archive_dir", root_dir / "archive"))
+
+
+if store_config.get("shared_memory", False):
+    # 封存由 loader 行程負責寫入，worker 只讀取
+    store = SharedSheetStore(
+        archive=archive,
+        spool=SheetSpool(store_config.get("spool_dir", root_dir / "spool")))
+else:
+    store = SheetStore(archive=archive)
+    if archive is not None:
+        # 推送的資料可能很頻繁，合併後再寫入封存
+        archive_writer = BatchedArchiveWriter(
+            archive, delay=store_config.get("archive_delay", 30))
+        store.on_refresh(archive_writer.submit)
+    # 沒有 loader 行程時由各 worker 自行定期重新讀取，沒有使用者連線也會評估警示並寫入封存
+    refresh_minutes = store_config.get("refresh_minutes", 5)
+    if refresh_minutes:
+        refresh_periodically(store, refresh_minutes * 60)
+
+
+@store.on_refresh
+def refit_forecasts(sheets: dict):
+    """
+    表格更新後立即把新的資料加進預測模型，不必等到有人開啟趨勢圖
+    """
+    for location in sheets:
+        store.forecast(location)
+
+
+def reload_all(indoor_sheet: Value, outdoor_sheet: Value, force: bool = False):
+    """
+    重新讀取所有表格
+
+    force 為 False 時沿用其他 session 已讀取的表格
+    """
+    with ui.Progress() as p:
+        p.set(message="讀取檔案", detail="這需要花一點時間...")
+        if force:
+            store.refresh()
+        else:
+            store.ensure_loaded()
+        p.inc(amount=.5, detail="讀取中")
+        indoor_sheet.set(store.get("indoor"))
+        outdoor_sheet.set(store.get("outdoor"))
+        p.inc(amount=.5)
+        p.set(message="完成！", detail="")